@@ -1,21 +1,300 @@
 #!/usr/bin/env python
 import sys
-import paramiko
 import os
 import logging
+import logging.handlers
 import argparse
 import getpass
 import re
-import ansible.runner
-import ansible.playbook
+import pipes
+import shlex
+import socket
 import time
-from ansible import callbacks, utils
-from ansible.inventory import Inventory
+import threading
+import Queue
+import json
+import hashlib
+import hmac
+import functools
+import glob
+import resource
+import fcntl
+import base64
+import multiprocessing
+import select
+import errno
+import signal
+import shutil
+import tempfile
+import cStringIO
+import xml.etree.cElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple, deque, OrderedDict
+from contextlib import contextmanager
 from colored import fore, back, style
-from IPy import IP
 from subprocess import Popen, call, CalledProcessError, check_output, PIPE, STDOUT
-from progress.spinner import Spinner
-from bs4 import BeautifulSoup
+# paramiko, ansible and IPy are slow to import, so they are imported by
+# the stages which use them.  --help, argument errors and runs which skip
+# those stages don't pay for them.  extras/startup_benchmark.py checks this.
+
+# The bkr cli can be swapped out (e.g. for extras/fakes/bkr) by setting DEPLOY_BKR
+BKR_BINARY = os.environ.get("DEPLOY_BKR", "/usr/bin/bkr")
+# Task statuses/results that mean a beaker job will never complete successfully
+BEAKER_FAILED_STATUSES = ('Aborted', 'Cancelled')
+BEAKER_FAILED_RESULTS = ('Fail', 'Panic')
+# Upper bound and growth factor for the job-results polling interval
+BEAKER_POLL_MAX = 120
+BEAKER_POLL_BACKOFF = 1.5
+# The task which holds the machine once it is installed, every task before it
+# has to be Completed for the host to be usable
+BEAKER_RESERVE_TASK = "/distribution/reservesys"
+# Discovery results (disk inventory, ...) are cached here between runs
+CACHE_DIR = "extras/cache"
+# Completed stages are recorded here for --resume
+STATE_FILE = "extras/deploy.state"
+# Global options and environment profiles, see ConfigStore
+CONFIG_FILE = "extras/deploy.cfg"
+# Rotating logs of the ansible-playbook output
+LOG_DIR = "extras/logs"
+# One json profile of stage timings is written here per run
+PROFILE_DIR = "extras/profiles"
+# ansible.cfg generated for each deployment and the fact cache it points at
+ANSIBLE_CFG = "extras/ansible.cfg"
+FACT_CACHE_DIR = "extras/facts"
+# Seconds cached facts stay valid for
+FACT_CACHE_TTL = 7200
+# Upper bound for the forks of the generated ansible.cfg, each fork is a
+# python process on this machine
+ANSIBLE_MAX_FORKS = 50
+
+""" Run profiling """
+# The deployment and stage each thread is working on, so the counters bumped
+# from helpers shared by every deployment (the ssh backends, bkr calls) land
+# in the right stage of the right deployment's profile
+thread_state = threading.local()
+
+def current_context():
+    return getattr(thread_state, 'context', None)
+
+def current_stage():
+    return getattr(thread_state, 'stage', None)
+
+# Seconds covered by at least one of the (start, end) intervals
+def active_time(intervals):
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+# Collects wall time, per-host times, retries and subprocess/ssh counts for
+# every deploy stage of one deployment.  The wall time of a stage only counts
+# the time at least one of its calls was running, so a per-host stage waiting
+# on its hosts' reservations isn't charged for the wait in between.
+class RunProfile(object):
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = OrderedDict()
+        # Settings which change the timings, e.g. the ansible.cfg in use
+        self.settings = {}
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = { 'intervals': [], 'busy': 0.0,
+                                   'running': 0, 'running_rss_kb': 0,
+                                   'calls': 0, 'retries': 0, 'subprocesses': 0,
+                                   'ssh_connections': 0, 'ssh_commands': 0,
+                                   'peak_rss_growth_kb': 0, 'hosts': {} }
+        return self.stages[stage]
+
+    # Time a stage, or one host's part of it
+    @contextmanager
+    def span(self, stage, host=None):
+        previous = current_stage()
+        thread_state.stage = stage
+        with self.lock:
+            # Stages are listed in the order they started
+            record = self._stage(stage)
+            # How far the peak memory of the process (in KB on linux) rises
+            # is measured over each stretch of time any call of the stage
+            # runs, so concurrent calls aren't counted more than once
+            if record['running'] == 0:
+                record['running_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['running'] += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            thread_state.stage = previous
+            with self.lock:
+                record['intervals'].append((start, end))
+                record['busy'] += end - start
+                record['calls'] += 1
+                record['running'] -= 1
+                if record['running'] == 0:
+                    record['peak_rss_growth_kb'] += (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                                                     record['running_rss_kb'])
+            if host is not None:
+                self.add_host_time(stage, host, end - start)
+
+    def add_host_time(self, stage, host, seconds):
+        with self.lock:
+            hosts = self._stage(stage)['hosts']
+            hosts[host] = hosts.get(host, 0) + seconds
+
+    def count(self, stage, counter, n=1):
+        with self.lock:
+            self._stage(stage)[counter] += n
+
+    def as_dict(self):
+        with self.lock:
+            stages = OrderedDict()
+            for stage, record in self.stages.iteritems():
+                stages[stage] = dict(record)
+                stages[stage]['wall'] = active_time(record['intervals'])
+                for internal in ('intervals', 'running', 'running_rss_kb'):
+                    del stages[stage][internal]
+            return { 'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                              time.localtime(self.started)),
+                     'argv': sys.argv[1:],
+                     'total': time.time() - self.started,
+                     'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     'settings': self.settings,
+                     'stages': stages }
+
+    def save(self):
+        path = "%s/%s.json" % (self.directory, time.strftime(
+            '%Y%m%d-%H%M%S', time.localtime(self.started)))
+        atomic_write(path, json.dumps(self.as_dict(), indent=2))
+        return path
+
+# Add to one of the counters of the stage running in this thread
+def profile_count(counter, n=1):
+    context = current_context()
+    stage = current_stage()
+    if context is None or stage is None:
+        return
+    context.profile.count(stage, counter, n)
+
+# Carry the calling thread's deployment and stage into a function run on
+# another thread
+def bind_context(func):
+    context = current_context()
+    stage = current_stage()
+    def bound(*func_args):
+        previous = (current_context(), current_stage())
+        thread_state.context, thread_state.stage = context, stage
+        try:
+            return func(*func_args)
+        finally:
+            thread_state.context, thread_state.stage = previous
+    return bound
+
+# Time every call of a stage function, whose first argument is the
+# DeployContext.  With per_host the second argument is the hostname and the
+# time is also recorded against that host.
+def profiled(stage, per_host=False):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(context, *func_args, **kwargs):
+            host = func_args[0] if per_host else None
+            previous = current_context()
+            thread_state.context = context
+            try:
+                with context.profile.span(stage, host):
+                    return func(context, *func_args, **kwargs)
+            finally:
+                thread_state.context = previous
+        return wrapper
+    return decorator
+
+# Compare saved run profiles stage by stage, oldest first.  With no paths the
+# two most recent profiles are compared.
+def profile_report(paths):
+    if not paths:
+        if os.path.isdir(PROFILE_DIR):
+            paths = sorted(glob.glob("%s/*.json" % PROFILE_DIR))[-2:]
+    if not paths:
+        print "deploy.py: error: no run profiles found in %s" % PROFILE_DIR
+        exit(1)
+    profiles = []
+    for path in paths:
+        with open(path) as f:
+            profiles.append(json.load(f, object_pairs_hook=OrderedDict))
+    stages = []
+    for profile in profiles:
+        for stage in profile['stages']:
+            if stage not in stages:
+                stages.append(stage)
+    print "%-26s" % "stage (wall time)" + "".join(
+        "%20s" % os.path.splitext(os.path.basename(path))[0][:19] for path in paths)
+    for stage in stages + ['total']:
+        row = "%-26s" % stage
+        for profile in profiles:
+            if stage == 'total':
+                row += "%19.1fs" % profile['total']
+            elif stage in profile['stages']:
+                record = profile['stages'][stage]
+                row += "%19.1fs" % record['wall']
+            else:
+                row += "%20s" % "-"
+        print row
+    # Counters of the newest run next to the oldest one explain most changes
+    print "\n%-26s%10s%10s%10s%10s%10s%10s" % ("stage", "busy", "calls", "retries", "processes", "ssh conns", "ssh cmds")
+    for stage in stages:
+        for label, profile in (("first", profiles[0]), ("last", profiles[-1])):
+            if len(profiles) == 1 and label == "last":
+                continue
+            record = profile['stages'].get(stage)
+            if record is None:
+                continue
+            print "%-26s%9.1fs%10d%10d%10d%10d%10d" % (
+                "%s (%s)" % (stage, label) if len(profiles) > 1 else stage,
+                record['busy'], record['calls'], record['retries'],
+                record['subprocesses'],
+                record['ssh_connections'], record['ssh_commands'])
+
+""" Deployment context """
+# Everything one deployment works with in place of module globals: its
+# arguments, the hosts of each role, its credentials and the working
+# directory its ansible_hosts, ansible.cfg, state, logs and profiles live in.
+# The ssh backend and the beaker slots are shared by all the deployments of a
+# --manifest run, so their limits hold across every cluster.
+class DeployContext(object):
+    def __init__(self, name, args, workdir="."):
+        self.name = name
+        self.args = args
+        self.workdir = workdir
+        self.roles = None
+        self.mon_list = []
+        # osds new to the cluster, whose journals get sized
+        self.osd_list = []
+        # Hosts to reserve, key and subscribe
+        self.beaker_host_list = set()
+        # Hosts the playbook is limited to, None for every host
+        self.playbook_limit = None
+        self.ansible_inventory = None
+        self.beaker_password = None
+        self.subscription_username = None
+        self.subscription_password = None
+        self.ssh_pool = None
+        # Bounds the bkr commands running at once
+        self.beaker_slots = None
+        self.profile = RunProfile(self.path(PROFILE_DIR))
+
+    # A path inside the working directory
+    def path(self, name):
+        return os.path.normpath(os.path.join(self.workdir, name))
 
 """ Provide parser validation """
 def is_valid_hostname(hostname):
@@ -26,6 +305,127 @@ def is_valid_hostname(hostname):
     allowed = re.compile("(?!-)[A-Z\d-]{1,63}(?<!-)$", re.IGNORECASE)
     return all(allowed.match(x) for x in hostname.split("."))
 
+""" Pre-flight checks """
+# Port the reachability sweep connects to
+SSH_PORT = 22
+# Most DNS lookups the pre-flight check runs at once
+RESOLVE_WORKERS = 64
+
+# hostname -> address, filled by the pre-flight check and used by the ssh
+# backends so each host is only looked up once per run
+resolved_addresses = {}
+
+# Look a host up, returns (host, address, error)
+def resolve_host(host):
+    try:
+        infos = socket.getaddrinfo(host, SSH_PORT, 0, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        return host, None, e.args[-1]
+    return host, infos[0][4][0], None
+
+# Resolve every host concurrently, the lookups still running at deadline are
+# given up on.  Returns (addresses, errors), both keyed by hostname.
+def resolve_hosts(hosts, deadline):
+    addresses = {}
+    errors = {}
+    if not hosts:
+        return addresses, errors
+    pool = ThreadPool(min(RESOLVE_WORKERS, len(hosts)))
+    try:
+        results = pool.imap_unordered(resolve_host, hosts)
+        for each in hosts:
+            try:
+                host, address, error = results.next(max(deadline - time.time(), 0))
+            except multiprocessing.TimeoutError:
+                break
+            if error is None:
+                addresses[host] = address
+            else:
+                errors[host] = error
+    finally:
+        # Lookups stuck past the deadline are left to finish on their own
+        pool.close()
+    for host in hosts:
+        if host not in addresses and host not in errors:
+            errors[host] = "no DNS answer in time"
+    return addresses, errors
+
+# Start a non-blocking connect to every address at once and wait for all of
+# them together until deadline.  Returns hostname -> error for the hosts that
+# refused or did not answer.
+def port_sweep(addresses, port, deadline):
+    errors = {}
+    pending = {}
+    poller = select.poll()
+    for host, address in addresses.iteritems():
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        error = sock.connect_ex((address, port))
+        if error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock.fileno()] = (host, sock)
+            poller.register(sock, select.POLLOUT)
+        else:
+            errors[host] = os.strerror(error)
+            sock.close()
+    while pending:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            events = poller.poll(timeout * 1000)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, event in events:
+            host, sock = pending.pop(fd)
+            poller.unregister(fd)
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                errors[host] = os.strerror(error)
+            sock.close()
+    for host, sock in pending.values():
+        errors[host] = "no answer on port %d in time" % port
+        sock.close()
+    return errors
+
+# The addresses more than one of the hostnames resolve to, as
+# address -> [hostnames]
+def duplicate_addresses(addresses):
+    hosts = {}
+    for host, address in addresses.iteritems():
+        hosts.setdefault(address, []).append(host)
+    return dict((address, sorted(names)) for address, names in hosts.iteritems()
+                if len(names) > 1)
+
+# Check every host of the deployments before anything is reserved: each name
+# has to resolve, no two names may be the same machine, and hosts which are
+# not about to be reserved (and installed) by beaker have to answer on the
+# ssh port.  DNS and the port sweep each get timeout seconds for all of the
+# hosts together.
+def preflight(contexts, timeout):
+    start = time.time()
+    hosts = sorted(set(host for context in contexts for host in context.roles.hosts()))
+    print (fore.LIGHT_BLUE + style.BOLD + "\nChecking %d host(s) before starting" % len(hosts) + style.RESET)
+    addresses, errors = resolve_hosts(hosts, start + timeout)
+    sweep = {}
+    for context in contexts:
+        for host in context.roles.hosts():
+            if host in addresses and (context.args.no_beaker or
+                                      host not in context.beaker_host_list):
+                sweep[host] = addresses[host]
+    errors.update(port_sweep(sweep, SSH_PORT, time.time() + timeout))
+    duplicates = duplicate_addresses(addresses)
+    for host in sorted(errors):
+        print (fore.RED + "  %s: %s" % (host, errors[host]) + style.RESET)
+    for address in sorted(duplicates):
+        print (fore.RED + "  %s all resolve to %s" % (", ".join(duplicates[address]), address) + style.RESET)
+    if errors or duplicates:
+        print (fore.RED + "deploy.py: Error: the pre-flight check failed for %d host(s), fix the host names or re-run the script with --skip-preflight" % (len(errors) + sum(len(names) for names in duplicates.values())) + style.RESET)
+        exit(1)
+    resolved_addresses.update(addresses)
+    print (fore.GREEN + "%d host(s) resolved, %d answered on port %d (%.1fs)" % (len(addresses), len(sweep), SSH_PORT, time.time() - start) + style.RESET)
 
 """ Check to ensure the package prerequisites exist """
 def packages_satisfied():
@@ -34,54 +434,159 @@ def packages_satisfied():
         print "deploy.py: error: ansible is not installed.  Install it before \
         continuing."
         exit(1)
-    if os.path.isfile('/usr/bin/bkr') == False:
+    if os.path.isfile(BKR_BINARY) == False:
         print "deploy.py: error: the bkr cli is not installed.  Install it before \
         continuing."
         exit(1)
 
 """ Configuration file creation and variables """
-# We need to create an empty inventory file to satisfy the inventory variable
-def create_ansiblehosts():
-    if os.path.isfile('ansible_hosts') == False:
-        f = open('ansible_hosts', 'w')
-        f.write("")
-    ansibleInventory = Inventory(host_list='ansible_hosts')
-
 """ On first run generate a config file """
-def save_config(filename, option, value):
-    # If the value is an array, we'll need to convert it to a string
-    if type(value) is list:
-        new_value = ""
-        for sub_value in value:
-            if new_value == "":
-                new_value = sub_value
-            else:
-                new_value = sub_value + "," + new_value
-                value = new_value
-    config = open(filename, "a")
-    config.write(option + "=" + value + "\n")
-    config.close()
-
-def load_config(filename):
-    configs = {}
-    # Open config file and read in values (if it exists)
-    if os.path.exists(filename):
-        config = open(filename, "r")
-        content = config.read()
-        lines = content.split("\n")
-        for data in lines:
-            # If the line returned from the config file is
-            # trying to set a value, load it up and set it in
-            # our configs dictionary
-            if data.find("=") != -1:
-                option = data.split("=")[0]
-                value = data.split("=")[1]
-                # if the value has a comma in it, we need
-                # to build an array instead of a string
-                if value.find(",") != -1:
-                    value = value.split(",")
-                configs[option] = value
-    return configs
+# Options kept as comma-delimited lists, every other option is a string
+CONFIG_LISTS = ('mons', 'osds', 'mdss', 'rgws', 'restapis', 'clients')
+# Options an environment profile can provide, mapped to their argument
+CONFIG_ARGS = OrderedDict([
+    ('mons', 'mons'),
+    ('osds', 'osds'),
+    ('mdss', 'mdss'),
+    ('rgws', 'rgws'),
+    ('restapis', 'restapis'),
+    ('clients', 'clients'),
+    ('roles_file', 'roles_file'),
+    ('directory', 'directory'),
+    ('journal_size', 'osd_journal_size'),
+    ('public_network', 'public_network'),
+    ('cluster_network', 'cluster_network'),
+])
+
+# extras/deploy.cfg holds option=value lines.  Options before the first
+# [section] are global, such as the subscription-manager credentials, and each
+# section is an environment profile selected with --env (the hosts, networks
+# and passwords of one lab).  The file is parsed once and only read again when
+# its mtime changes.  Changes are buffered until flush() replaces the whole
+# file in a single write, which keeps the comments and layout of the file.
+# The file holds passwords, so it is only readable by the user.
+class ConfigStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.sections = OrderedDict([(None, OrderedDict())])
+        # The lines of the file as last read
+        self.lines = []
+        # mtime and size of the file as last read, None if it didn't exist
+        self.stamp = None
+        self.pending = OrderedDict()
+
+    def read_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def load(self):
+        stamp = self.read_stamp()
+        if stamp is not None and stamp == self.stamp:
+            return
+        sections = OrderedDict([(None, OrderedDict())])
+        lines = []
+        if stamp is not None:
+            # Created readable by everyone by older versions
+            if os.stat(self.path).st_mode & 077:
+                os.chmod(self.path, 0600)
+            section = None
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+                for line in lines:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if line.startswith("[") and line.endswith("]"):
+                        section = line[1:-1].strip()
+                        sections.setdefault(section, OrderedDict())
+                    elif "=" in line:
+                        option, value = line.split("=", 1)
+                        sections[section][option.strip()] = self.parse(option.strip(), value)
+        self.sections = sections
+        self.lines = lines
+        self.stamp = stamp
+        # Buffered changes win over whatever is on disk
+        for (section, option), value in self.pending.items():
+            self.sections.setdefault(section, OrderedDict())[option] = value
+
+    def parse(self, option, value):
+        if option in CONFIG_LISTS:
+            return [item.strip() for item in value.split(",") if item.strip()]
+        return value
+
+    def format(self, value):
+        if isinstance(value, (list, tuple)):
+            return ",".join(value)
+        return str(value)
+
+    def environments(self):
+        self.load()
+        return [section for section in self.sections if section is not None]
+
+    # The options of one environment profile, or the global ones
+    def section(self, env=None):
+        self.load()
+        return dict(self.sections.get(env, {}))
+
+    # Look an option up in the environment first, then the global options
+    def get(self, option, env=None, default=None):
+        self.load()
+        for section in (env, None):
+            if option in self.sections.get(section, {}):
+                return self.sections[section][option]
+        return default
+
+    def set(self, option, value, env=None):
+        self.load()
+        if option in CONFIG_LISTS and not isinstance(value, (list, tuple)):
+            value = self.parse(option, value)
+        self.pending[(env, option)] = value
+        self.sections.setdefault(env, OrderedDict())[option] = value
+
+    # The options of section which are not in written yet, as lines
+    def unwritten(self, section, written):
+        return ["%s=%s" % (option, self.format(value))
+                for option, value in self.sections.get(section, {}).items()
+                if (section, option) not in written]
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.load()
+        # Rewrite the options already in the file in place, add the new ones
+        # at the end of their section and the new sections at the end
+        lines = []
+        written = set()
+        section = None
+        # Blank and comment lines ending a section belong to the next one
+        def close_section():
+            trailing = []
+            while lines and (not lines[-1].strip() or lines[-1].strip().startswith("#")):
+                trailing.insert(0, lines.pop())
+            lines.extend(self.unwritten(section, written))
+            written.update((section, option) for option in self.sections.get(section, {}))
+            lines.extend(trailing)
+        for line in self.lines:
+            stripped = line.strip()
+            if stripped.startswith("[") and stripped.endswith("]"):
+                close_section()
+                section = stripped[1:-1].strip()
+            elif stripped and not stripped.startswith("#") and "=" in stripped:
+                option = stripped.split("=", 1)[0].strip()
+                written.add((section, option))
+                line = "%s=%s" % (option, self.format(self.sections[section][option]))
+            lines.append(line)
+        close_section()
+        for section in self.sections:
+            options = self.unwritten(section, written)
+            if options:
+                lines.extend(["", "[%s]" % section] + options)
+        atomic_write(self.path, "\n".join(lines).lstrip("\n") + "\n", mode=0600)
+        self.stamp = self.read_stamp()
+        self.pending.clear()
 
 # Ask questions to build user's configuration
 # type_ should be either 'string' or 'array'
@@ -101,45 +606,291 @@ def question(type_,question = None):
         answer = answer.split(",")
     return answer
 
+""" known_hosts management """
+# How many backups of known_hosts to keep next to it
+KNOWN_HOSTS_BACKUPS = 5
+
+# The hostnames a known_hosts line applies to, [host]:port entries are
+# reduced to the host.  Hashed entries are returned as is.
+# The (hostname, port) of every name on a known_hosts line, the port is None
+# unless the name is in the [host]:port form
+def known_hosts_names(line):
+    fields = line.split()
+    # Skip blank lines, comments and markers such as @revoked
+    if fields and fields[0].startswith("@"):
+        fields = fields[1:]
+    if not fields or fields[0].startswith("#"):
+        return []
+    names = []
+    for pattern in fields[0].split(","):
+        port = None
+        if pattern.startswith("[") and "]" in pattern:
+            pattern, port = pattern[1:].split("]", 1)
+            port = port.lstrip(":") or None
+        names.append((pattern, port))
+    return names
+
+# ssh hashes hostnames with HMAC-SHA1 keyed on a per-entry salt.  The inner
+# and outer hashes are keyed once per entry so checking a hostname against it
+# only costs two hash copies rather than a new hmac object.
+HMAC_INNER_PAD = "".join(chr(x ^ 0x36) for x in range(256))
+HMAC_OUTER_PAD = "".join(chr(x ^ 0x5c) for x in range(256))
+
+def salted_sha1(salt):
+    key = salt.ljust(64, "\0")
+    return (hashlib.sha1(key.translate(HMAC_INNER_PAD)),
+            hashlib.sha1(key.translate(HMAC_OUTER_PAD)))
+
+# Serialize read-modify-write cycles on known_hosts between concurrent runs
+@contextmanager
+def known_hosts_lock(path):
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# A known_hosts file parsed once into an index of hostname -> line numbers.
+# Hashed (|1|salt|hash) entries are kept aside and matched by hashing the
+# requested hostnames with each entry's salt.  ssh hashes the [host]:port form
+# for other ports than 22, so those are hashed for the ssh port and every port
+# found in the file as well.
+class KnownHosts(object):
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.hashed = []
+        self.ports = set([str(SSH_PORT)])
+        self.removed = set()
+        with open(path) as f:
+            self.lines = f.readlines()
+        for number, line in enumerate(self.lines):
+            for name, port in known_hosts_names(line):
+                if port is not None:
+                    self.ports.add(port)
+                if name.startswith("|1|"):
+                    try:
+                        salt, digest = name[3:].split("|")
+                        self.hashed.append((number,)
+                                           + salted_sha1(base64.b64decode(salt))
+                                           + (base64.b64decode(digest),))
+                    except (ValueError, TypeError):
+                        continue
+                else:
+                    self.index.setdefault(name, []).append(number)
+
+    # Line numbers of every entry for exactly these hostnames
+    def find(self, hosts):
+        numbers = set()
+        for host in hosts:
+            numbers.update(self.index.get(host, []))
+        names = list(hosts) + ["[%s]:%s" % (host, port)
+                               for host in hosts for port in sorted(self.ports)]
+        # The hmac is inlined, this loop runs once per hashed entry and name
+        for number, inner, outer, digest in self.hashed:
+            for name in names:
+                check = inner.copy()
+                check.update(name)
+                keyed = outer.copy()
+                keyed.update(check.digest())
+                if keyed.digest() == digest:
+                    numbers.add(number)
+                    break
+        return numbers
+
+    # Drop every entry for these hostnames, returns how many lines went
+    def remove(self, hosts):
+        numbers = self.find(hosts) - self.removed
+        self.removed.update(numbers)
+        return len(numbers)
+
+    # Replace the file (after backing it up) with the remaining entries
+    def save(self):
+        backup = "%s.deploy-%s-%d" % (self.path, time.strftime("%Y%m%d%H%M%S"),
+                                      os.getpid())
+        atomic_write(backup, "".join(self.lines), fsync=True)
+        backups = sorted(glob.glob("%s.deploy-*" % self.path))
+        for old in backups[:-KNOWN_HOSTS_BACKUPS]:
+            os.unlink(old)
+        atomic_write(self.path, "".join(line for number, line in enumerate(self.lines)
+                                        if number not in self.removed), fsync=True)
+
+""" Inventory generation """
+# The ceph-ansible host groups, in the order they are written to ansible_hosts
+INVENTORY_ROLES = ('mons', 'osds', 'mdss', 'rgws', 'restapis', 'clients')
+
+# Maps each role to its hosts and keeps the variables of every host.  A host
+# with several roles is only kept once, and every operation is linear in the
+# number of hosts.
+class InventoryBuilder(object):
+    def __init__(self):
+        self.roles = OrderedDict((role, []) for role in INVENTORY_ROLES)
+        self.members = dict((role, set()) for role in INVENTORY_ROLES)
+        self.host_vars = OrderedDict()
+
+    def add(self, role, host, variables=None):
+        if role not in self.roles:
+            raise ValueError("unknown role %s, expected one of %s"
+                             % (role, ", ".join(INVENTORY_ROLES)))
+        if host not in self.members[role]:
+            self.members[role].add(host)
+            self.roles[role].append(host)
+        self.host_vars.setdefault(host, OrderedDict()).update(variables or {})
+
+    # Every host, in the order they were first added
+    def hosts(self):
+        return self.host_vars.keys()
+
+    def as_dict(self):
+        return dict((role, hosts) for role, hosts in self.roles.items() if hosts)
+
+    # The inventory as an ansible INI file, host variables are written next to
+    # each appearance of the host
+    def ini(self):
+        lines = []
+        for role, hosts in self.roles.items():
+            if not hosts:
+                continue
+            lines.append("[%s]" % role)
+            for host in hosts:
+                lines.append(" ".join([host] + ["%s=%s" % (option, pipes.quote(str(value)))
+                                                for option, value in self.host_vars[host].items()]))
+        return "\n".join(lines) + "\n"
+
+    # The same inventory as an ansible Inventory object, built in memory
+    def inventory(self):
+        from ansible.inventory import Inventory
+        from ansible.inventory.group import Group
+        inventory = Inventory(host_list=self.hosts())
+        all_group = inventory.get_group('all')
+        hosts = dict((host.name, host) for host in all_group.get_hosts())
+        for name, variables in self.host_vars.items():
+            for option, value in variables.items():
+                hosts[name].set_variable(option, value)
+        for role, members in self.roles.items():
+            if not members:
+                continue
+            group = Group(name=role)
+            for host in members:
+                group.add_host(hosts[host])
+            all_group.add_child_group(group)
+            inventory.add_group(group)
+        return inventory
+
+# Add the roles and host variables of an ansible INI style file, e.g.
+#   [mons]
+#   ceph1.example.com monitor_interface=eth1
+def read_roles_file(path, builder):
+    role = None
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                role = line[1:-1].strip()
+                if role not in builder.roles:
+                    raise ValueError("%s:%d: unknown role [%s], expected one of %s"
+                                     % (path, number, role, ", ".join(INVENTORY_ROLES)))
+                continue
+            if role is None:
+                raise ValueError("%s:%d: %s is not in a [role] section" % (path, number, line))
+            fields = shlex.split(line)
+            variables = OrderedDict()
+            for field in fields[1:]:
+                if "=" not in field:
+                    raise ValueError("%s:%d: expected option=value, got %s" % (path, number, field))
+                option, value = field.split("=", 1)
+                variables[option] = value
+            builder.add(role, fields[0], variables)
+
+# Merge the requested roles into an existing inventory for --expand.  Returns
+# the merged inventory, the hosts which are not in the existing one at all and
+# the hosts which gained a role.
+def merge_inventory(existing, requested):
+    merged = InventoryBuilder()
+    for builder in (existing, requested):
+        for role, hosts in builder.roles.items():
+            for host in hosts:
+                merged.add(role, host, builder.host_vars[host])
+    added = [host for host in requested.hosts() if host not in existing.host_vars]
+    changed = [host for host in requested.hosts()
+               if any(host in requested.members[role] and
+                      host not in existing.members[role]
+                      for role in INVENTORY_ROLES)]
+    return merged, added, changed
+
+""" Generated ansible.cfg """
+# Write the ansible.cfg used by a deployment to path, sized to its hosts, and
+# point ansible at it.  Connections are reused through ControlPersist and
+# commands are pipelined over them, and facts are cached in FACT_CACHE_DIR so
+# the plays of site.yml (and ansible_ping, which fills the cache) share them.
+# Returns the settings for the run profile.
+def write_ansible_cfg(path, host_count):
+    settings = OrderedDict([
+        ('forks', max(5, min(host_count, ANSIBLE_MAX_FORKS))),
+        ('gathering', 'smart'),
+        ('fact_caching', 'jsonfile'),
+        ('fact_caching_connection', os.path.abspath(FACT_CACHE_DIR)),
+        ('fact_caching_timeout', FACT_CACHE_TTL),
+    ])
+    ssh_settings = OrderedDict([
+        ('pipelining', 'True'),
+        ('ssh_args', '-o ControlMaster=auto -o ControlPersist=60s'),
+    ])
+    lines = ["# Generated by deploy.py for %d host(s), changes are overwritten" % host_count,
+             "[defaults]"]
+    lines.extend("%s = %s" % (option, value) for option, value in settings.items())
+    lines.append("\n[ssh_connection]")
+    lines.extend("%s = %s" % (option, value) for option, value in ssh_settings.items())
+    atomic_write(path, "\n".join(lines) + "\n")
+    # ansible reads its configuration when first imported, which the lazy
+    # imports leave until after this point.  Only the fact cache settings,
+    # which every deployment shares, matter to the in-process ping.
+    os.environ["ANSIBLE_CONFIG"] = os.path.abspath(path)
+    settings.update(ssh_settings)
+    return settings
+
+# Store the facts gathered by the setup module the way ansible's jsonfile fact
+# cache does, so the playbook doesn't gather them again
+def cache_facts(host, facts):
+    facts = dict(facts, module_setup=True)
+    atomic_write(os.path.join(FACT_CACHE_DIR, host), json.dumps(facts))
+
 """ Generate Ansible Prerequisites """
-def generate_prereqs():
-    beaker_hosts = args.mons + "," + args.osds
-    beaker_host_list = set(beaker_hosts.split(","))
-    # Create the ansible inventory hosts file
+# Create the ansible inventory hosts file
+@profiled("generate_prereqs")
+def write_inventory(context):
     print (fore.LIGHT_BLUE + style.BOLD + "\nCreating ansible inventory" +
     style.RESET)
     print "Writing hostnames out to ansible-hosts file"
+    atomic_write(context.path('ansible_hosts'), context.roles.ini())
+    if context.args.ansible_defaults == False:
+        settings = write_ansible_cfg(context.path(ANSIBLE_CFG), len(context.roles.hosts()))
+        context.profile.settings['ansible_cfg'] = settings
+        print "Wrote %s with %d forks" % (context.path(ANSIBLE_CFG), settings['forks'])
+    context.ansible_inventory = context.roles.inventory()
 
-    f = open('ansible_hosts', 'w')
-    f.write('[mons] \n')
-    for each in mon_list:
-        f.write(each)
-        f.write('\n')
-    f.write('[osds] \n')
-    for each in osd_list:
-        f.write(each)
-        f.write('\n')
-    f.close()
-    #TODO: Add rgw, restapi support to inventory creation.
-
-    # Wipe specific lines for each host in the known_hosts file to prevent remote
-    # host identification failures from breaking script progress
+# Wipe specific lines for each host in the known_hosts file to prevent remote
+# host identification failures from breaking script progress
+@profiled("generate_prereqs")
+def prune_known_hosts(context):
     print "Removing re-used hosts from the .ssh/known_hosts file to prevent host key verification failures"
-    host_list = mon_list + osd_list
-    homedir = os.path.expanduser('~')
-    # Rename the existing known_hosts file
-    os.rename("%s/.ssh/known_hosts" % (homedir), "%s/.ssh/known_hosts_old" % (homedir) )
-    # Write a new known_hosts file without any of the targetted hostnames for
-    # this run
-    with open("%s/.ssh/known_hosts_old" % (homedir), "r" ) as sshfile_input:
-        with open("%s/.ssh/known_hosts" % (homedir), "wb" ) as sshfile_output:
-            for line in sshfile_input:
-                if not line.startswith(tuple(beaker_host_list)):
-                    sshfile_output.write(line)
-
-    # Generate keyless ssh for the playbook to run
-    print (fore.LIGHT_BLUE + style.BOLD + "\nGenerating keyless ssh for the root user on each host." + style.RESET)
+    path = os.path.expanduser('~/.ssh/known_hosts')
+    if not os.path.isfile(path):
+        return
+    with known_hosts_lock(path):
+        known_hosts = KnownHosts(path)
+        removed = known_hosts.remove(context.beaker_host_list)
+        if removed:
+            known_hosts.save()
+    print "Removed %d known_hosts entries" % removed
 
+# Keyless ssh for the playbook needs the user's public key, check for it
+# before anything is started and return its contents
+def read_public_key():
+    homedir = os.path.expanduser('~')
     # Check to make sure the user has an id_rsa.pub file before continuing
     if os.path.isfile('%s/.ssh/id_rsa.pub' % (homedir) ) == False:
         # For now we'll just prompt the user to run ssh-keygen on their own.  We
@@ -148,23 +899,396 @@ def generate_prereqs():
         print (fore.RED + "No /.ssh/id_rsa.pub file found in home directory \
         please create one using ssh-keygen and restart this script")
         exit(1)
-    else:
-        pass
+    with open('%s/.ssh/id_rsa.pub' % (homedir)) as f:
+        return f.read().strip()
+
+""" Pooled ssh sessions """
+# Result of running a command on one host.  error is set instead of
+# exit_status when the host could not be reached at all.
+CommandResult = namedtuple('CommandResult', 'host exit_status stdout stderr error')
+
+# Open a paramiko session to a host as root using the beaker root password
+def ssh_connect(host, password, timeout=None):
+    import paramiko
+    profile_count('ssh_connections')
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(resolved_addresses.get(host, host),
+                username="root",
+                password=password,
+                look_for_keys=False,
+                timeout=timeout
+                )
+    return ssh
+
+# Keeps one paramiko session per hostname open for the whole run so every
+# remote step reuses it, and runs commands across many hosts in parallel.  At
+# most self.workers commands run at a time, however many deployments share
+# the pool.
+class SSHPool(object):
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.sessions = {}
+        self.passwords = {}
+        self.slots = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.host_locks = {}
+
+    # Set the root password used to log into hosts
+    def add_hosts(self, hosts, password):
+        with self.lock:
+            for host in hosts:
+                self.passwords[host] = password
+
+    # Return the open session for host, connecting (or reconnecting a dropped
+    # session) if needed.  Only one connection attempt per host is in flight.
+    def session(self, host):
+        with self.lock:
+            host_lock = self.host_locks.setdefault(host, threading.Lock())
+        with host_lock:
+            ssh = self.sessions.get(host)
+            transport = ssh.get_transport() if ssh is not None else None
+            if transport is None or not transport.is_active():
+                ssh = ssh_connect(host, self.passwords.get(host),
+                                  timeout=self.timeout)
+                self.sessions[host] = ssh
+            return ssh
+
+    # Run a command on a single host and wait for it to exit
+    def run(self, host, command):
+        import paramiko
+        with self.slots:
+            try:
+                ssh = self.session(host)
+                profile_count('ssh_commands')
+                stdin, stdout, stderr = ssh.exec_command(command,
+                                                         timeout=self.timeout)
+                output = stdout.read()
+                errors = stderr.read()
+                return CommandResult(host, stdout.channel.recv_exit_status(),
+                                     output, errors, None)
+            except (paramiko.SSHException, socket.error, EOFError) as e:
+                # Drop the session so the next attempt reconnects
+                self.close(host)
+                return CommandResult(host, None, "", "",
+                                     str(e) or e.__class__.__name__)
+
+    # Run a command on every host at once, at most self.workers at a time.
+    # command may also be a function of the hostname.  Returns a dict of
+    # hostname -> CommandResult.
+    def run_all(self, hosts, command):
+        hosts = list(hosts)
+        if not hosts:
+            return {}
+        if callable(command):
+            run_host = lambda host: self.run(host, command(host))
+        else:
+            run_host = lambda host: self.run(host, command)
+        run_host = bind_context(run_host)
+        pool = ThreadPool(min(self.workers, len(hosts)))
+        try:
+            return dict((result.host, result)
+                        for result in pool.imap_unordered(run_host, hosts))
+        finally:
+            pool.close()
+
+    def close(self, host=None):
+        with self.lock:
+            if host is None:
+                hosts = self.sessions.keys()
+            else:
+                hosts = [host]
+            for each in hosts:
+                ssh = self.sessions.pop(each, None)
+                if ssh is not None:
+                    ssh.close()
+
+""" Event loop ssh backend """
+# Feeds the beaker root password to the ssh cli, see OpenSSHLoop
+SSH_ASKPASS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extras", "ssh-askpass")
+
+# One command running through the OpenSSHLoop
+class SSHJob(object):
+    def __init__(self, host, command):
+        self.host = host
+        self.command = command
+        self.process = None
+        self.deadline = None
+        self.output = {}
+        self.result = None
+        self.done = threading.Event()
+
+# Runs commands through the OpenSSH cli instead of paramiko.  A single thread
+# multiplexes the output of every ssh child with poll(), so hundreds of
+# hosts can be worked on at once without a thread per host.  Like SSHPool a
+# connection per host is kept open, as an ssh ControlMaster, and at most
+# self.workers commands run at a time.  The password is handed to ssh by
+# extras/ssh-askpass since the children have no terminal to prompt on.
+class OpenSSHLoop(object):
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.control_dir = tempfile.mkdtemp(prefix="deploy-ssh-")
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.running = []
+        self.hosts = set()
+        self.passwords = {}
+        self.thread = None
+        # Written to whenever a job is queued so poll() wakes up
+        self.wakeup = os.pipe()
+        # Every running job holds two pipes, make room for them
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = workers * 2 + 64
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            if hard != resource.RLIM_INFINITY:
+                wanted = min(wanted, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        self.env = dict(os.environ, SSH_ASKPASS=SSH_ASKPASS,
+                        SSH_ASKPASS_REQUIRE="force")
+        self.env.setdefault("DISPLAY", ":0")
 
-    for each in beaker_host_list:
-        ssh_deploy_key_args = [ 'ssh-deploy-key',
-                    '-u', 'root',
-                    '-p', '%s' % (beakerPassword),
-                    '%s' % (each) ]
-        ssh_deploy_key = Popen(ssh_deploy_key_args)
-        ssh_deploy_key.wait()
-    #TODO: Need error handling, if we raise a 'CONNECTION FAILURE' we need to
-    ## exit and log it
+    # Set the root password used to log into hosts
+    def add_hosts(self, hosts, password):
+        with self.lock:
+            for host in hosts:
+                self.passwords[host] = password
+
+    def ssh_args(self, host):
+        # Host keys are accepted and not recorded, as with paramiko's
+        # AutoAddPolicy.  Addresses found by the pre-flight check save ssh
+        # looking the host up again.
+        return ["ssh", "-T", "-l", "root",
+                "-o", "HostName=%s" % resolved_addresses.get(host, host),
+                "-o", "StrictHostKeyChecking=no",
+                "-o", "UserKnownHostsFile=/dev/null",
+                "-o", "LogLevel=ERROR",
+                "-o", "PubkeyAuthentication=no",
+                "-o", "NumberOfPasswordPrompts=1",
+                "-o", "ConnectTimeout=%d" % self.timeout,
+                "-o", "ControlMaster=auto",
+                "-o", "ControlPath=%s/%%h" % self.control_dir,
+                "-o", "ControlPersist=5m",
+                host]
+
+    def submit(self, jobs):
+        with self.lock:
+            for job in jobs:
+                if job.host not in self.hosts:
+                    self.hosts.add(job.host)
+                    profile_count('ssh_connections')
+                profile_count('ssh_commands')
+                profile_count('subprocesses')
+                self.pending.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.daemon = True
+                self.thread.start()
+        os.write(self.wakeup[1], "x")
+
+    # Run a command on a single host and wait for it to exit
+    def run(self, host, command):
+        job = SSHJob(host, command)
+        self.submit([job])
+        job.done.wait()
+        return job.result
+
+    # Run a command on every host at once, at most self.workers at a time.
+    # command may also be a function of the hostname.  Returns a dict of
+    # hostname -> CommandResult.
+    def run_all(self, hosts, command):
+        if callable(command):
+            jobs = [SSHJob(host, command(host)) for host in hosts]
+        else:
+            jobs = [SSHJob(host, command) for host in hosts]
+        self.submit(jobs)
+        for job in jobs:
+            job.done.wait()
+        return dict((job.host, job.result) for job in jobs)
+
+    def start(self, job):
+        try:
+            env = dict(self.env, DEPLOY_SSH_PASSWORD=self.passwords.get(job.host) or "")
+            job.process = Popen(self.ssh_args(job.host) + [job.command],
+                                stdin=open(os.devnull), stdout=PIPE,
+                                stderr=PIPE, env=env,
+                                close_fds=True, preexec_fn=os.setsid)
+        except OSError as e:
+            self.finish(job, CommandResult(job.host, None, "", "", str(e)))
+            return
+        job.deadline = time.time() + self.timeout
+        for pipe in (job.process.stdout, job.process.stderr):
+            fcntl.fcntl(pipe, fcntl.F_SETFL,
+                        fcntl.fcntl(pipe, fcntl.F_GETFL) | os.O_NONBLOCK)
+            job.output[pipe.fileno()] = []
+        self.running.append(job)
+
+    def finish(self, job, result):
+        job.result = result
+        job.done.set()
+
+    # Collect a job whose ssh exited.  ssh exits 255 when it could not
+    # connect, which is reported as an error like SSHPool does.
+    def reap(self, job):
+        self.running.remove(job)
+        stdout = "".join(job.output[job.process.stdout.fileno()])
+        stderr = "".join(job.output[job.process.stderr.fileno()])
+        job.process.stdout.close()
+        job.process.stderr.close()
+        if job.process.returncode == 255:
+            self.finish(job, CommandResult(job.host, None, stdout, stderr,
+                                           stderr.strip() or "ssh connection failed"))
+        else:
+            self.finish(job, CommandResult(job.host, job.process.returncode,
+                                           stdout, stderr, None))
+
+    # Read everything a non-blocking pipe has to offer, "" marks its EOF
+    def drain(self, fd, chunks):
+        while chunks[-1:] != [""]:
+            try:
+                chunks.append(os.read(fd, 65536))
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+
+    def kill(self, job):
+        try:
+            os.killpg(job.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        job.process.wait()
+        self.running.remove(job)
+        job.process.stdout.close()
+        job.process.stderr.close()
+        self.finish(job, CommandResult(job.host, None, "", "",
+                                       "timed out after %d seconds" % self.timeout))
+
+    # Run the jobs until none are left.  Should the loop itself fail, every
+    # job still queued or running is finished with the error so no caller is
+    # left waiting on it.
+    def loop(self):
+        try:
+            self.run_jobs()
+        except Exception as e:
+            with self.lock:
+                for job in list(self.running):
+                    try:
+                        os.killpg(job.process.pid, signal.SIGKILL)
+                        job.process.wait()
+                    except OSError:
+                        pass
+                    self.finish(job, CommandResult(job.host, None, "", "",
+                                                   "ssh backend failed: %s" % e))
+                for job in self.pending:
+                    self.finish(job, CommandResult(job.host, None, "", "",
+                                                   "ssh backend failed: %s" % e))
+                self.running = []
+                self.pending.clear()
+                self.thread = None
+
+    def run_jobs(self):
+        while True:
+            with self.lock:
+                while self.pending and len(self.running) < self.workers:
+                    # Left queued until started, so a failure can finish it
+                    self.start(self.pending[0])
+                    self.pending.popleft()
+                if not self.pending and not self.running:
+                    self.thread = None
+                    return
+            # select() can't watch descriptors past FD_SETSIZE (1024)
+            poller = select.poll()
+            poller.register(self.wakeup[0], select.POLLIN)
+            for job in self.running:
+                for fd, chunks in job.output.items():
+                    if chunks[-1:] != [""]:
+                        poller.register(fd, select.POLLIN)
+            # The persisted master may hold stderr open after ssh exits, so
+            # exited children are checked for on every pass as well
+            timeout = min([job.deadline for job in self.running] +
+                          [time.time() + 0.1]) - time.time()
+            try:
+                readable = set(fd for fd, event in poller.poll(max(timeout, 0) * 1000))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 4096)
+            now = time.time()
+            for job in list(self.running):
+                for fd, chunks in job.output.items():
+                    if fd in readable:
+                        self.drain(fd, chunks)
+                stdout_done = job.output[job.process.stdout.fileno()][-1:] == [""]
+                if stdout_done and job.process.poll() is not None:
+                    # Pick up whatever stderr is left without waiting for EOF
+                    stderr = job.process.stderr.fileno()
+                    self.drain(stderr, job.output[stderr])
+                    self.reap(job)
+                elif now >= job.deadline:
+                    self.kill(job)
+
+    # Stop the ssh masters, of one host or of every host
+    def close(self, host=None):
+        with self.lock:
+            if host is None:
+                hosts = list(self.hosts)
+            else:
+                hosts = [host]
+            self.hosts.difference_update(hosts)
+        for each in hosts:
+            with open(os.devnull, "w") as devnull:
+                call(self.ssh_args(each)[:-1] + ["-O", "exit", each],
+                     stdout=devnull, stderr=devnull)
+        if host is None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+# Remote command backends, selected with --ssh-backend.  Each one provides
+# run(host, command) and run_all(hosts, command) returning CommandResults,
+# add_hosts(hosts, password) to set the root password of hosts and
+# close(host=None) to drop the connections it keeps open.
+SSH_BACKENDS = {
+    'paramiko': SSHPool,
+    'openssh': OpenSSHLoop,
+}
+
+# Describe a failed CommandResult for error output
+def command_error(result):
+    if result.error is not None:
+        return result.error
+    return (result.stderr.strip() or result.stdout.strip() or
+            "exited with status %s" % result.exit_status)
+
+""" Keyless ssh distribution """
+# Push the public key to a single host, retrying with backoff if it fails
+@profiled("generate_prereqs", per_host=True)
+def deploy_key(context, host, public_key):
+    # Append the key to root's authorized_keys unless it is already there
+    authorize_key = ("umask 077; mkdir -p ~/.ssh && touch ~/.ssh/authorized_keys && "
+                     "{ grep -qxF %s ~/.ssh/authorized_keys || echo %s >> ~/.ssh/authorized_keys; } && "
+                     "{ ! type restorecon >/dev/null 2>&1 || restorecon -F ~/.ssh ~/.ssh/authorized_keys; }"
+                     % (pipes.quote(public_key), pipes.quote(public_key)))
+    for attempt in range(context.args.ssh_retries + 1):
+        if attempt > 0:
+            print "%s: retrying key deployment in %d seconds" % (host, 2 ** attempt)
+            profile_count('retries')
+            time.sleep(2 ** attempt)
+        result = context.ssh_pool.run(host, authorize_key)
+        if result.exit_status == 0:
+            print (fore.GREEN + "%s: key deployed" % host + style.RESET)
+            return
+    print (fore.RED + "%s: unable to deploy the ssh key (%s), check the root password in extras/deploy.cfg and that the host is reachable" % (host, command_error(result)) + style.RESET)
+    exit(1)
 
 """ Beaker reservation """
-def beaker_reserve():
+@profiled("beaker_reserve")
+def beaker_kinit(context):
     # Grab a kerberos ticket
     print (fore.LIGHT_BLUE + style.BOLD + "\nRequesting a kerberos ticket for beaker use." + style.RESET)
+    profile_count('subprocesses')
     if call(['klist', '-s']) == 0:
         print "User already has a valid ticket, continuing."
         pass
@@ -173,6 +1297,7 @@ def beaker_reserve():
         ## so; that needs to be corrected.
         password = getpass.getpass('Enter the password for your kerberos user: ')
         kinit = '/usr/bin/kinit'
+        profile_count('subprocesses')
         kinit = Popen(kinit, stdin=PIPE, stdout=PIPE, stderr=PIPE)
         kinit.stdin.write('%s\n' % password)
         kinit.wait()
@@ -186,137 +1311,817 @@ def beaker_reserve():
         ##    print e.output
         ##    exit(1)
 
-    # Reserve the machines specified in -m and -o in bkr and watch the jobs for
-    # completion
-    print (fore.LIGHT_BLUE + style.BOLD + "\nReserving the requested mons and osds in beaker and configuring them for use with Ceph" + style.RESET)
-    job_id_list = []
-
-    for each in beaker_host_list:
-        bkr_args = [ '/usr/bin/bkr', "workflow-simple",
-                  "--family", "RedHatEnterpriseLinux7",
-                  "--variant", "Server",
-                  "--arch", "x86_64",
-                  "--task", "/distribution/reservesys",
-                  "--ks-meta='autopart_type=plain'",
-                  "--machine", "%s" % each ]
+# Reserve the machines specified in -m and -o in bkr and watch the jobs for
+# completion.  on_ready is called with each host as soon as its own job is
+# Completed.  Watching stops early once the stopping event is set.
+@profiled("beaker_reserve")
+def beaker_reserve(context, hosts, on_ready, stopping):
+    if not hosts:
+        return
+    print (fore.LIGHT_BLUE + style.BOLD + "\nReserving the requested hosts in beaker and configuring them for use with Ceph" + style.RESET)
+    pool = ThreadPool(min(context.args.beaker_workers, len(hosts)))
+    try:
+        # Submit every host at once, the submissions themselves are slow
+        # round trips to the beaker server
+        jobs = {}
+        submitted = time.time()
+        for host, job_id, output in pool.imap_unordered(
+                bind_context(lambda host: beaker_submit(context, host)), hosts):
+            #FIXME: Need proper error handling during kinit but this is a crappy
+            # workaround for now.
+            if job_id is None:
+                print (fore.RED + 'deploy.py: Error: job submission for %s failed, kinit may have failed. Check klist to ensure a kerberos ticket was properly created'
+                % host + style.RESET)
+                print output
+                exit(1)
+            print "Created a new job for %s: J:%s" % (host, job_id)
+            jobs[job_id] = host
+
+        print (fore.LIGHT_BLUE + style.BOLD + "\nWatching the jobs and waiting for a completed status. This process may take a while to complete." + fore.RED
+        + style.BOLD + " Do not interrupt the script!" + style.RESET)
+        beaker_watch(context, jobs, pool, on_ready, submitted, stopping)
+    finally:
+        pool.close()
+
+# Submit a reservation job for a single host, returns (host, job id, output)
+# with a job id of None if the submission failed
+def beaker_submit(context, host):
+    bkr_args = [ BKR_BINARY, "workflow-simple",
+              "--family", "RedHatEnterpriseLinux7",
+              "--variant", "Server",
+              "--arch", "x86_64",
+              "--task", "/distribution/reservesys",
+              "--ks-meta='autopart_type=plain'",
+              "--machine", "%s" % host ]
+    with context.beaker_slots:
+        profile_count('subprocesses')
         bkr = Popen(bkr_args, stdout=PIPE, stderr=STDOUT)
         #FIXME: If job_id contains an Exception exit properly
-        job_id = bkr.stdout.read()
-        regex = "[0-9]+"
-        job_id_edited = re.findall(regex, job_id)
-        #FIXME: Need proper error handling during kinit but this is a crappy
-        # workaround for now.
-        try:
-            print "Created a new job: " + job_id_edited[0]
-        except IndexError:
-            print (fore.RED + 'deploy.py: IndexError: kinit may have failed. Check klist to ensure a kerberos ticket was properly created'
-            + style.RESET)
-            exit(1)
-        else:
-            job_id_list.append(job_id_edited[0])
-            bkr.wait()
-
-    print (fore.LIGHT_BLUE + style.BOLD + "\nWatching the jobs and waiting for a completed status. This process may take a while to complete." + fore.RED
-    + style.BOLD + " Do not interrupt the script!" + style.RESET)
-    for each in job_id_list:
-        each = "J:" + each
-        bkr_args = [ "/usr/bin/bkr", "job-results", "%s" % (each) ]
-        # Query job-results every 30 seconds for a Completed status
-        while True:
-            bkr_watch = Popen(bkr_args, stdout=PIPE)
-            b = BeautifulSoup(bkr_watch.stdout.read())
-            time.sleep(30)
-            if b.task["status"] == 'Completed':
-                break
-            if b.task["status"] == 'Fail' or 'Failed':
-                print (fore.RED + style.BOLD + "The beaker job has failed." + style.RESET + style.BOLD + "Please check the status of each job at https://beaker.engineering.redhat.com/jobs/ then re-run the script." + style.RESET)
+        output = bkr.communicate()[0]
+    job_id = re.findall("[0-9]+", output)
+    if bkr.returncode != 0 or not job_id:
+        return host, None, output
+    return host, job_id[0], output
+
+# Status summaries of a beaker job, its recipes (one per machine) and their
+# tasks as reported by bkr job-results
+JobStatus = namedtuple('JobStatus', 'id status result recipes')
+RecipeStatus = namedtuple('RecipeStatus', 'id system status result tasks')
+TaskStatus = namedtuple('TaskStatus', 'name status result')
+
+# Whether any part of the job has failed
+def job_failed(job):
+    statuses = [(job.status, job.result)]
+    for recipe in job.recipes:
+        statuses.append((recipe.status, recipe.result))
+        statuses.extend((task.status, task.result) for task in recipe.tasks)
+    return any(status in BEAKER_FAILED_STATUSES or result in BEAKER_FAILED_RESULTS
+               for status, result in statuses)
+
+# Whether every recipe got through the tasks before the reservation
+def job_ready(job):
+    if not job.recipes:
+        return False
+    for recipe in job.recipes:
+        tasks = [task for task in recipe.tasks if task.name != BEAKER_RESERVE_TASK]
+        if not tasks or any(task.status != 'Completed' for task in tasks):
+            return False
+    return True
+
+# Short progress description of a job, e.g. "Running, 1/2 tasks done"
+def job_progress(job):
+    tasks = [task for recipe in job.recipes for task in recipe.tasks]
+    if not tasks:
+        return job.status
+    done = len([task for task in tasks if task.status == 'Completed'])
+    running = [task.name for task in tasks if task.status == 'Running']
+    progress = "%s, %d/%d tasks done" % (job.status, done, len(tasks))
+    if running:
+        progress += ", running %s" % running[0]
+    return progress
+
+# Build a JobStatus from job-results xml without keeping the document around.
+# Elements are dropped as soon as they are read, so the task logs and results
+# beaker includes don't cost memory, and parsing stops at the job element when
+# the whole job has been aborted or cancelled.
+def parse_job_results(stream):
+    job = None
+    recipes = []
+    tasks = []
+    recipe = None
+    for event, element in ElementTree.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            if element.tag == "job":
+                job = element.attrib.copy()
+                if job.get("status") in BEAKER_FAILED_STATUSES:
+                    break
+            elif element.tag == "recipe":
+                recipe = element.attrib.copy()
+                tasks = []
+            continue
+        if element.tag == "task":
+            tasks.append(TaskStatus(element.get("name"), element.get("status"),
+                                    element.get("result")))
+        elif element.tag == "recipe" and recipe is not None:
+            recipes.append(RecipeStatus(recipe.get("id"), recipe.get("system"),
+                                        recipe.get("status"), recipe.get("result"),
+                                        tuple(tasks)))
+            recipe = None
+        if element.tag != "job":
+            element.clear()
+    if job is None:
+        return None
+    return JobStatus(job.get("id"), job.get("status"), job.get("result"),
+                     tuple(recipes))
+
+# Last job-results output digest and summary per job, polls returning the
+# same output are not parsed again
+job_status_cache = {}
+
+# Query the status of a job, returns (job id, JobStatus or None)
+def beaker_job_status(context, job_id):
+    bkr_args = [ BKR_BINARY, "job-results", "J:%s" % (job_id) ]
+    with context.beaker_slots:
+        profile_count('subprocesses')
+        bkr_watch = Popen(bkr_args, stdout=PIPE, stderr=PIPE)
+        output = bkr_watch.communicate()[0]
+    if bkr_watch.returncode != 0:
+        return job_id, None
+    digest = hashlib.sha1(output).digest()
+    cached = job_status_cache.get(job_id)
+    if cached is not None and cached[0] == digest:
+        return job_id, cached[1]
+    try:
+        job = parse_job_results(cStringIO.StringIO(output))
+    except ElementTree.ParseError:
+        job = None
+    job_status_cache[job_id] = (digest, job)
+    return job_id, job
+
+# Poll every outstanding job in parallel until all of them are ready.
+# The interval grows while nothing changes and drops back to
+# --beaker-poll-interval whenever a job makes progress.  Exits as soon as any
+# job fails and returns once stopping is set, e.g. because another stage of
+# the deployment failed.
+def beaker_watch(context, jobs, pool, on_ready, submitted, stopping):
+    outstanding = dict(jobs)
+    last_seen = {}
+    interval = context.args.beaker_poll_interval
+    while not stopping.is_set():
+        progressed = False
+        for job_id, job in pool.imap_unordered(
+                bind_context(lambda job_id: beaker_job_status(context, job_id)),
+                outstanding.keys()):
+            host = outstanding[job_id]
+            if job is None:
+                # bkr or the beaker server hiccuped, ask again next round
+                continue
+            if job_failed(job):
+                print (fore.RED + style.BOLD + "The beaker job J:%s for %s has failed (%s). " % (job_id, host, job_progress(job)) + style.RESET + style.BOLD + "Please check the status of each job at https://beaker.engineering.redhat.com/jobs/ then re-run the script." + style.RESET)
                 exit(1)
-            if b.task["status"] != 'Completed':
-                print 'Checking job status for %s again in 30 seconds...' % each
+            if job_ready(job):
+                print (fore.GREEN + "J:%s for %s is installed and reserved" % (job_id, host) + style.RESET)
+                del outstanding[job_id]
+                job_status_cache.pop(job_id, None)
+                context.profile.add_host_time("beaker_reserve", host,
+                                              time.time() - submitted)
+                on_ready(host)
+                progressed = True
+            elif last_seen.get(job_id) != job_progress(job):
+                print "J:%s for %s is %s" % (job_id, host, job_progress(job))
+                last_seen[job_id] = job_progress(job)
+                progressed = True
+        if not outstanding:
+            break
+        if progressed:
+            interval = context.args.beaker_poll_interval
+        else:
+            interval = min(interval * BEAKER_POLL_BACKOFF, BEAKER_POLL_MAX)
+        print 'Checking %d outstanding job(s) again in %d seconds...' % (len(outstanding), interval)
+        stopping.wait(interval)
+    if outstanding:
+        print "Stopped watching %d job(s), their reservations are left in beaker" % len(outstanding)
 
 """ Make sure we can access the hosts in the inventory via the ansible ping
 module """
-def ansible_ping():
-    print (fore.LIGHT_BLUE + style.BOLD + "\nContacting the hosts using the ansible ping module" + style.RESET)
-    runner = ansible.runner.Runner(
-        module_name='ping',
-        module_args='',
-        pattern='*',
-        inventory=ansibleInventory,
-        remote_user='root'
-        )
-    if "'failed': True" in str(runner.run()):
-        print (fore.RED + "One or more of the hosts failed to respond to the ping")
-        print runner.run()
+""" Reachability check """
+# Outcome of pinging a single host.  status is ok, failed or unreachable and
+# latency is the number of seconds from the start of the run to its answer.
+PingResult = namedtuple('PingResult', 'host status latency message')
+
+# ansible calls the runner callbacks from its forked workers, so the time each
+# host answered is handed back to the parent over a multiprocessing queue.
+# With a single fork ansible calls them in-process instead, those times are
+# kept in a dict.  The class is built on first use as it derives from an
+# ansible class.
+def ping_timer():
+    from ansible import callbacks
+
+    class PingTimer(callbacks.DefaultRunnerCallbacks):
+        def __init__(self):
+            callbacks.DefaultRunnerCallbacks.__init__(self)
+            self.queue = multiprocessing.Queue()
+            self.pid = os.getpid()
+            self.local = {}
+            self.started = time.time()
+
+        def answered(self, host):
+            latency = time.time() - self.started
+            if os.getpid() == self.pid:
+                self.local[host] = latency
+            else:
+                self.queue.put((host, latency))
+
+        def on_ok(self, host, res):
+            self.answered(host)
+
+        def on_failed(self, host, res, ignore_errors=False):
+            self.answered(host)
+
+        def on_unreachable(self, host, res):
+            self.answered(host)
+
+        # Only called once the run is over, the workers have flushed their
+        # part of the queue by the time they exit
+        def latencies(self):
+            latencies = dict(self.local)
+            while True:
+                try:
+                    host, latency = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                latencies[host] = latency
+            self.queue.close()
+            self.queue.join_thread()
+            return latencies
+
+    return PingTimer()
+
+# ansible 1.9 keeps its settings and callback state in module globals, so
+# the deployments of a --manifest run take turns running it in-process
+ansible_lock = threading.Lock()
+
+# Ping the hosts with a single ansible run, every host is contacted at once
+# (up to forks) so the run takes at most one timeout.  With the setup module
+# the hosts' facts are put in the fact cache on the way.
+def ping_hosts(context, hosts, forks, timeout, module='ping'):
+    import ansible.runner
+    with ansible_lock:
+        timer = ping_timer()
+        runner = ansible.runner.Runner(
+            module_name=module,
+            module_args='',
+            pattern=":".join(hosts),
+            inventory=context.ansible_inventory,
+            remote_user='root',
+            forks=min(forks, len(hosts)),
+            timeout=timeout,
+            callbacks=timer
+            )
+        results = runner.run()
+    profile_count('ssh_connections', len(hosts))
+    elapsed = time.time() - timer.started
+    latencies = timer.latencies()
+    pinged = {}
+    for host, res in results.get('contacted', {}).items():
+        if res.get('failed') or (module == 'ping' and res.get('ping') != 'pong'):
+            status = 'failed'
+        else:
+            status = 'ok'
+            if module == 'setup':
+                cache_facts(host, res.get('ansible_facts', {}))
+        pinged[host] = PingResult(host, status, latencies.get(host, elapsed),
+                                  res.get('msg', ''))
+    for host, res in results.get('dark', {}).items():
+        pinged[host] = PingResult(host, 'unreachable',
+                                  latencies.get(host, elapsed),
+                                  res.get('msg', ''))
+    # Hosts missing from both means ansible never got to them
+    for host in hosts:
+        if host not in pinged:
+            pinged[host] = PingResult(host, 'unreachable', elapsed,
+                                      "no result from ansible")
+    return pinged
+
+@profiled("ansible_ping")
+def ansible_ping(context):
+    args = context.args
+    # An --expand which only gives existing hosts new roles has none to add
+    if not context.beaker_host_list:
+        print "No new hosts to contact, skipping the ansible ping"
+        return
+    # The setup module proves a host is reachable just as well and fills the
+    # fact cache the generated ansible.cfg uses
+    module = 'ping' if args.ansible_defaults else 'setup'
+    print (fore.LIGHT_BLUE + style.BOLD + "\nContacting the hosts using the ansible %s module" % module + style.RESET)
+    results = {}
+    pending = sorted(context.beaker_host_list)
+    # Only the unreachable hosts are tried again, a host which answered but
+    # failed the module won't do any better the second time
+    for attempt in range(args.ssh_retries + 1):
+        if attempt > 0:
+            print "%d host(s) unreachable, retrying in %d seconds" % (len(pending), 2 ** attempt)
+            profile_count('retries')
+            time.sleep(2 ** attempt)
+        results.update(ping_hosts(context, pending, args.ping_forks, args.ping_timeout, module))
+        pending = [host for host in pending
+                   if results[host].status == 'unreachable']
+        if not pending:
+            break
+    answered = [result for result in results.values() if result.status != 'unreachable']
+    for result in answered:
+        context.profile.add_host_time("ansible_ping", result.host, result.latency)
+    failed = sorted((result for result in results.values() if result.status != 'ok'),
+                    key=lambda result: (result.status, result.host))
+    if failed:
+        print (fore.RED + "%d of %d host(s) failed to respond to the ping" % (len(failed), len(results)) + style.RESET)
+        for result in failed:
+            print (fore.RED + "  %s: %s %s" % (result.host, result.status, result.message) + style.RESET)
         exit(1)
-    else:
-        print (fore.GREEN + "Success" + style.RESET)
-        pass
+    if not results:
+        return
+    slowest = max(results.values(), key=lambda result: result.latency)
+    print (fore.GREEN + "Success, %d host(s) answered (slowest %s in %.1fs)" % (len(results), slowest.host, slowest.latency) + style.RESET)
 
 """ Subscribe hosts to correct repos using subscription-manager """
-def subscribe_hosts():
-    # ssh to the hosts and subscribe them to the Employee SKU in subscription-manager
-    print (fore.LIGHT_BLUE + style.BOLD + "\nContacting the hosts and registering them using subscription-manager" + style.RESET)
-    registerHosts = "subscription-manager register --username=%s --password=%s ; subscription-manager attach --pool=8a85f9833e1404a9013e3cddf95a0599 ; subscription-manager repos --disable=*" % (subscriptionUsername, subscriptionPassword)
-    for each in beaker_host_list:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(each,
-                    username="root",
-                    password=beakerPassword,
-                    look_for_keys=False
-                    )
-        stdin, stdout, stderr = ssh.exec_command(registerHosts)
+# The Employee SKU every host gets attached to
+SUBSCRIPTION_POOL = "8a85f9833e1404a9013e3cddf95a0599"
+
+# Reads the registration, consumed pools and enabled repos of a host in one
+# round trip.  identity only succeeds on a registered host, and the other
+# commands may fail on an unregistered one, so the probe always exits 0 and
+# only a failed ssh connection is reported as an error.
+SUBSCRIPTION_SEPARATOR = "--deploy.py--"
+SUBSCRIPTION_PROBE = ("subscription-manager identity >/dev/null 2>&1 && echo registered; "
+                      "echo %(sep)s; subscription-manager list --consumed 2>/dev/null; "
+                      "echo %(sep)s; subscription-manager repos --list-enabled 2>/dev/null; "
+                      "true"
+                      % {'sep': SUBSCRIPTION_SEPARATOR})
+
+# What subscription-manager reports about a host
+SubscriptionState = namedtuple('SubscriptionState', 'registered pools repos')
+
+def parse_subscription_state(output):
+    sections = output.split(SUBSCRIPTION_SEPARATOR + "\n")
+    if len(sections) != 3:
+        raise ValueError("unexpected output from subscription-manager")
+    registered, consumed, enabled = sections
+    return SubscriptionState(registered.strip() == "registered",
+                             re.findall(r'^Pool ID:\s+(\S+)', consumed, re.M),
+                             re.findall(r'^Repo ID:\s+(\S+)', enabled, re.M))
+
+# The steps taking a host from its current state to registered, attached to
+# SUBSCRIPTION_POOL and with every repo disabled, as (name, command) pairs
+def subscription_steps(context, state):
+    steps = []
+    if not state.registered:
+        steps.append(("register", "subscription-manager register --username=%s --password=%s"
+                      % (pipes.quote(context.subscription_username),
+                         pipes.quote(context.subscription_password))))
+    attach = not state.registered or SUBSCRIPTION_POOL not in state.pools
+    if attach:
+        steps.append(("attach", "subscription-manager attach --pool=%s" % SUBSCRIPTION_POOL))
+    # Attaching enables the default repos of the pool
+    if attach or state.repos:
+        steps.append(("disable repos", "subscription-manager repos --disable='*'"))
+    return steps
+
+@profiled("subscribe_hosts", per_host=True)
+def subscribe_host(context, host):
+    # ssh to the host and check what subscription-manager already has, the
+    # entitlement service is slow so only the missing steps are run
+    result = context.ssh_pool.run(host, SUBSCRIPTION_PROBE)
+    try:
+        if result.exit_status != 0:
+            raise ValueError(command_error(result))
+        steps = subscription_steps(context, parse_subscription_state(result.stdout))
+    except ValueError as e:
+        print (fore.RED + "%s: unable to read the subscription status (%s)" % (host, e) + style.RESET)
+        exit(1)
+    with context.profile.lock:
+        context.profile.settings.setdefault('subscription_steps', {})[host] = [name for name, command in steps]
+    if not steps:
+        print (fore.GREEN + "%s: already subscribed" % host + style.RESET)
+        return
+    # subscribe it to the Employee SKU in subscription-manager
+    result = context.ssh_pool.run(host, " && ".join(command for name, command in steps))
+    if result.exit_status != 0:
+        print (fore.RED + "%s: subscription failed (%s), check the subscription-manager credentials in extras/deploy.cfg" % (host, command_error(result)) + style.RESET)
+        exit(1)
+    print (fore.GREEN + "%s: subscribed (%s)" % (host, ", ".join(name for name, command in steps)) + style.RESET)
+
+""" OSD hardware discovery """
+# A single block device as reported by lsblk, size is in bytes
+BlockDevice = namedtuple('BlockDevice', 'name size type rotational mountpoint')
+
+# lsblk on RHEL 7 predates --json, so fall back to key="value" pairs
+LSBLK_COLUMNS = "NAME,SIZE,TYPE,ROTA,MOUNTPOINT"
+LSBLK_COMMAND = ("lsblk -J -b -o %s 2>/dev/null || lsblk -P -b -o %s"
+                 % (LSBLK_COLUMNS, LSBLK_COLUMNS))
+
+# Write a file by renaming a temp file over it so readers never see a partial
+# write.  The file keeps its permissions, new files get mode less the umask.
+# With fsync the data and the rename are flushed to disk before returning.
+def atomic_write(path, data, fsync=False, mode=0666):
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = os.path.join(directory, ".%s.%d.%s" % (
+        os.path.basename(path), os.getpid(), os.urandom(4).encode("hex")))
+    # Created like open() would, so the umask applies to new files
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0777)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+    if fsync:
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+# Cached discovery results live in CACHE_DIR/<kind>/<key>.json, shared by
+# every deployment
+def read_cache(context, kind, key):
+    if context.args.refresh_cache:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, kind, "%s.json" % key)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_cache(kind, key, data):
+    atomic_write(os.path.join(CACHE_DIR, kind, "%s.json" % key),
+                 json.dumps(data, indent=2, sort_keys=True))
+
+# Turn lsblk output (json or pairs) into a flat list of BlockDevice records
+def parse_lsblk(output):
+    def device(fields):
+        rota = fields.get("rota")
+        return BlockDevice(fields.get("name"),
+                           int(fields.get("size") or 0),
+                           fields.get("type"),
+                           rota in (True, "1", 1),
+                           fields.get("mountpoint") or None)
+    devices = []
+    if output.lstrip().startswith("{"):
+        pending = list(json.loads(output).get("blockdevices", []))
+        while pending:
+            fields = pending.pop(0)
+            devices.append(device(fields))
+            pending.extend(fields.get("children", []))
+    else:
+        for line in output.splitlines():
+            fields = dict((key.lower(), value) for key, value in
+                          re.findall(r'([A-Z]+)="([^"]*)"', line))
+            if fields:
+                devices.append(device(fields))
+    return devices
+
+# Run a discovery command on every host concurrently, only probing hosts that
+# have no cached result of this kind.  parse turns the command output into a
+# list of record tuples.  Returns a dict of hostname -> [record].
+def probe_hosts(context, kind, hosts, command, parse, record, description):
+    inventory = {}
+    for host in hosts:
+        cached = read_cache(context, kind, host)
+        if cached is not None:
+            inventory[host] = [record(*each) for each in cached]
+    missing = [host for host in hosts if host not in inventory]
+    if missing:
+        print "Probing %s on %d host(s)" % (description, len(missing))
+    failed = []
+    for host, result in context.ssh_pool.run_all(missing, command).iteritems():
+        try:
+            if result.exit_status != 0:
+                raise ValueError(command_error(result))
+            inventory[host] = parse(result.stdout)
+        except ValueError as e:
+            print (fore.RED + "%s: unable to read %s (%s)" % (host, description, e) + style.RESET)
+            failed.append(host)
+            continue
+        write_cache(kind, host, [list(each) for each in inventory[host]])
+    if failed:
+        exit(1)
+    return inventory
+
+# Collect the block devices of every host.  Returns a dict of
+# hostname -> [BlockDevice].
+def disk_inventory(context, hosts):
+    return probe_hosts(context, "disks", hosts, LSBLK_COMMAND, parse_lsblk,
+                       BlockDevice, "block devices")
+
+# The journal is sized at 1% of the host's largest disk, in MB
+def journal_size_mb(devices):
+    disks = [each.size for each in devices if each.type == "disk"]
+    if not disks:
+        return None
+    return int(round(max(disks) / 1024.0 / 1024.0 * 0.01))
+
+# Set variables in a host_vars file of the playbook, leaving any other
+# variables in it alone.  A value of None removes the variable.
+def write_host_vars(context, host, variables):
+    path = "%s/host_vars/%s" % (context.args.directory, host)
+    lines = []
+    if os.path.isfile(path):
+        with open(path) as f:
+            lines = [line for line in f
+                     if line.split(":", 1)[0].strip() not in variables]
+    elif all(value is None for value in variables.itervalues()):
+        return
+    for option, value in sorted(variables.iteritems()):
+        if value is not None:
+            lines.append("%s: %s\n" % (option, value))
+    atomic_write(path, "".join(lines))
+
+# The top level variables set in a group_vars file of the playbook, with
+# their values as written in it
+def read_group_vars(context, name):
+    path = "%s/group_vars/%s" % (context.args.directory, name)
+    variables = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line[:1] in ("#", " ", "\t") or ":" not in line:
+                    continue
+                option, value = line.split(":", 1)
+                variables[option.strip()] = value.strip()
+    return variables
+
+""" Network discovery """
+# A global scope address of a host.  network is the subnet it is on in CIDR
+# notation, speed the link speed in Mb/s (None when the driver doesn't say)
+# and default is set for addresses on the interface of the default route of
+# their address family.
+HostAddress = namedtuple('HostAddress', 'interface address network speed default')
+
+# ip on RHEL 7 predates -j, so fall back to its one line per entry output.
+# The IPv4 and IPv6 routes are listed separately and the link speeds are read
+# from sysfs.
+NETWORK_SEPARATOR = "--deploy.py--"
+NETWORK_COMMAND = ("if ip -j addr show >/dev/null 2>&1; then format=-j; else format=-o; fi; "
+                   "ip $format addr show; echo %(sep)s; "
+                   "ip $format -4 route show; echo %(sep)s; "
+                   "ip $format -6 route show 2>/dev/null; echo %(sep)s; "
+                   "for link in /sys/class/net/*; do "
+                   "echo ${link##*/} $(cat $link/speed 2>/dev/null); done"
+                   % {'sep': NETWORK_SEPARATOR})
+
+# The interfaces carrying a default route in the output of ip route
+def default_interfaces(route_output):
+    interfaces = set()
+    if route_output.lstrip().startswith("["):
+        for route in json.loads(route_output):
+            if route.get("dst") == "default" and route.get("dev"):
+                interfaces.add(route["dev"])
+    else:
+        for line in route_output.splitlines():
+            fields = line.split()
+            if fields and fields[0] == "default" and "dev" in fields:
+                interfaces.add(fields[fields.index("dev") + 1])
+    return interfaces
+
+# Turn the output of NETWORK_COMMAND into a list of HostAddress records
+def parse_networks(output):
+    from IPy import IP
+    sections = output.split(NETWORK_SEPARATOR + "\n")
+    if len(sections) != 4:
+        raise ValueError("unexpected output from ip")
+    addr_output, route4_output, route6_output, speed_output = sections
+    # (interface, address, prefix length) of every global address
+    addresses = []
+    if addr_output.lstrip().startswith("["):
+        for link in json.loads(addr_output):
+            for info in link.get("addr_info", []):
+                if info.get("family") in ("inet", "inet6") and info.get("scope") == "global":
+                    addresses.append((link["ifname"], info["local"], info["prefixlen"]))
+    else:
+        for line in addr_output.splitlines():
+            fields = line.split()
+            if len(fields) < 4 or fields[2] not in ("inet", "inet6") or "scope" not in fields:
+                continue
+            if fields[fields.index("scope") + 1] == "global":
+                address, prefixlen = fields[3].split("/")
+                addresses.append((fields[1].split("@")[0], address, int(prefixlen)))
+    defaults = {4: default_interfaces(route4_output),
+                6: default_interfaces(route6_output)}
+    speeds = {}
+    for line in speed_output.splitlines():
+        fields = line.split()
+        # Links without a speed (virtual ones, or down) report -1 or nothing
+        if len(fields) == 2 and fields[1].isdigit():
+            speeds[fields[0]] = int(fields[1])
+    return [HostAddress(interface, address,
+                        IP("%s/%d" % (address, prefixlen), make_net=True).strNormal(1),
+                        speeds.get(interface),
+                        interface in defaults[IP(address).version()])
+            for interface, address, prefixlen in addresses]
+
+# Collect the addresses of every host.  Returns a dict of
+# hostname -> [HostAddress].
+def network_inventory(context, hosts):
+    return probe_hosts(context, "networks", hosts, NETWORK_COMMAND, parse_networks,
+                       HostAddress, "network addresses")
+
+# The subnets every one of hosts has an address on, narrowest first.  Any
+# subnet a host reports is a candidate, so hosts configured with different
+# prefix lengths for the same network still agree on the narrower one.
+def shared_networks(addresses, hosts, exclude=None):
+    from IPy import IP
+    host_ips = dict((host, [IP(each.address) for each in addresses[host]])
+                    for host in hosts)
+    candidates = set(each.network for host in hosts for each in addresses[host])
+    shared = []
+    for candidate in candidates:
+        network = IP(candidate)
+        if exclude is not None and (network in exclude or exclude in network):
+            continue
+        if all(any(ip in network for ip in host_ips[host]) for host in hosts):
+            shared.append(network)
+    # Drop a shared subnet when a narrower one inside it is shared as well
+    shared = [network for network in shared
+              if not any(other != network and other in network for other in shared)]
+    return sorted(shared, key=lambda network: (-network.prefixlen(), network))
+
+# The addresses of host that are on network
+def addresses_on(addresses, host, network):
+    from IPy import IP
+    return [each for each in addresses[host] if IP(each.address) in network]
 
+# The addresses of host on network which are on an interface carrying none of
+# the host's addresses on exclude
+def separate_addresses_on(addresses, host, network, exclude):
+    shared = set(each.interface for each in addresses_on(addresses, host, exclude))
+    return [each for each in addresses_on(addresses, host, network)
+            if each.interface not in shared]
 
+# Pick the public and cluster networks from the addresses of every host.  Only
+# one address family is considered: IPv4, unless the hosts only have IPv6
+# default routes, or the family of a public network given on the command line,
+# which is used as is.  The public network is the shared subnet most hosts have
+# their default route on.  The cluster network is the subnet every osd host has
+# on an interface of its own, apart from the public network, with the fastest
+# slowest link.  It is None when there is no such subnet.
+def select_networks(addresses, hosts, osds, public=None):
+    from IPy import IP
+    if public is not None:
+        version = IP(public).version()
+    elif any(each.default and IP(each.address).version() == 4
+             for host in hosts for each in addresses[host]):
+        version = 4
+    elif any(each.default for host in hosts for each in addresses[host]):
+        version = 6
+    else:
+        version = 4
+    addresses = dict((host, [each for each in host_addresses
+                             if IP(each.address).version() == version])
+                     for host, host_addresses in addresses.items())
+    if public is None:
+        candidates = shared_networks(addresses, hosts)
+        if not candidates:
+            return None, None
+        def default_routes(network):
+            return sum(1 for host in hosts
+                       if any(each.default for each in addresses_on(addresses, host, network)))
+        # max() keeps the first, so narrower subnets win ties
+        public = max(candidates, key=default_routes).strNormal(1)
+    cluster = None
+    if osds:
+        def separate(network):
+            return all(separate_addresses_on(addresses, host, network, IP(public))
+                       for host in osds)
+        def slowest_link(network):
+            speeds = [max(each.speed for each in
+                          separate_addresses_on(addresses, host, network, IP(public)))
+                      for host in osds]
+            return min(speeds) if None not in speeds else -1
+        candidates = [network for network in
+                      shared_networks(addresses, osds, exclude=IP(public))
+                      if separate(network)]
+        if candidates:
+            cluster = max(candidates, key=slowest_link).strNormal(1)
+    return public, cluster
+
+# Detect the public and/or cluster network for the hosts.  The selection is
+# cached per set of hosts, so re-runs against the same cluster skip the
+# probes entirely.
+def detect_networks(context, hosts, osds, public=None):
+    key = fingerprint(sorted(hosts), sorted(osds), public)
+    cached = read_cache(context, "network_selection", key)
+    if cached is not None:
+        return cached["public"], cached["cluster"]
+    addresses = network_inventory(context, hosts)
+    public, cluster = select_networks(addresses, hosts, osds, public)
+    if public is not None:
+        write_cache("network_selection", key, {"hosts": sorted(hosts),
+                                               "public": public,
+                                               "cluster": cluster})
+    return public, cluster
+
+""" group_vars templating """
+# Every group_vars file generated from its .sample, mapping a line in the
+# sample to its replacement.  Replacements are filled in from the settings
+# passed to render_group_vars().  Files whose .sample is missing from the
+# playbook are skipped.
+GROUP_VARS_TEMPLATES = {
+    'all': { # Enable RHCS with download from cdn
+             '#ceph_stable_rh_storage: false': 'ceph_stable_rh_storage: true',
+             '#ceph_stable_rh_storage_cdn_install: false': 'ceph_stable_rh_storage_cdn_install: true',
+             # Specify a OSD journal size, and use the journal size
+             # from args.osd_journal_size if provided
+             '#journal_size: 0': 'journal_size: %(journal_size)s',
+             # Specify public/private networks to use
+             '#public_network: 0.0.0.0/0': 'public_network: %(public_network)s',
+             '#cluster_network: "{{ public_network }}"': 'cluster_network: %(cluster_network)s',
+             # Enable or disable cephx
+             '#cephx: true': 'cephx: %(cephx)s'
+             },
+    'mons': { # Enable or disable cephx
+              '#cephx: true': 'cephx: %(cephx)s'
+              },
+    'osds': { # Enable or disable cephx
+              '#cephx: true': 'cephx: %(cephx)s',
+              # Activate the fsid variable since these are baremetal
+              '#fsid: "{{ cluster_uuid.stdout }}"': 'fsid: "{{ cluster_uuid.stdout }}"',
+              # Set OSD auto discovery
+              '#osd_auto_discovery: false': 'osd_auto_discovery: true',
+              # Enable journal colocation
+              '#journal_collocation: false': 'journal_collocation: true'
+              },
+}
+
+# Build one alternation regex out of all the replacements for a file so each
+# line is scanned once no matter how many replacements there are.  Longer
+# keys come first so a key never shadows a longer key it is a prefix of.
+def compile_replacements(replacements):
+    keys = sorted(replacements, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(key) for key in keys))
+    return lambda line: pattern.sub(lambda m: replacements[m.group(0)], line)
+
+# Render group_vars/<name> from group_vars/<name>.sample.  The file is only
+# rewritten (atomically) when its content changes.  Returns True if written.
+def render_group_vars(context, name, replacements, settings):
+    sample_path = '%s/group_vars/%s.sample' % (context.args.directory, name)
+    output_path = '%s/group_vars/%s' % (context.args.directory, name)
+    replace = compile_replacements(dict((src, target % settings)
+                                        for src, target in replacements.iteritems()))
+    with open(sample_path) as infile:
+        rendered = "".join(replace(line) for line in infile)
+    if os.path.isfile(output_path):
+        with open(output_path) as f:
+            if f.read() == rendered:
+                return False
+    atomic_write(output_path, rendered)
+    return True
 
 """ Ansible playbook editing """
-def build_playbook():
+@profiled("build_playbook")
+def build_playbook(context):
+    from IPy import IP
+    args = context.args
     # Generate the variables for configuration replacements
     print (fore.LIGHT_BLUE + style.BOLD + "\nEditing Ansible playbook located in the %s directory" % (args.directory) + style.RESET )
     # Determine what size the OSD journal should be if -j isn't supplied
-    if args.osd_journal_size == False:
-        # No value provided, so create one based on host device size
-        print "No osd journal size provided.  Generating one based on disk size on one of the provided osd hosts"
-        # Connect to one of the osd hosts and pull the largest disk size.
-        # FIXME: We're making a big assumption here that the disk sizes will all
-        # be similar enough across the osds, we'll probably want to fix this in
-        # the future.
-        lsblk_osd = "lsblk --output SIZE | grep 'G' | sort | head -1"
-        ssh.connect(osd_list[0],
-                    username="root",
-                    password=beakerPassword,
-                    look_for_keys=False
-                    )
-        stdin, stdout, stderr = ssh.exec_command(lsblk_osd)
-        # The output we receive is in GB
-        output = stdout.read()
-        regex = "[0-9]+"
-        # Redefine output with only numbers and perform the calculation to
-        # determine 1% of the size, set that as args.osd_journal_size
-        output = re.findall(regex, output)
-        journal_size_mb = int(output[0]) * 1024 * 0.01
-        args.osd_journal_size = int(round(journal_size_mb,1))
+    if not args.osd_journal_size:
+        # No value provided, so create one per osd host based on its largest
+        # disk, the hosts do not need to share the same hardware
+        print "No osd journal size provided.  Generating one for each osd host based on its largest disk"
+        journal_sizes = {}
+        for host, devices in disk_inventory(context, context.osd_list).iteritems():
+            journal_sizes[host] = journal_size_mb(devices)
+            if journal_sizes[host] is None:
+                print (fore.RED + "deploy.py: Error: no disks found on %s to size the osd journal from, please re-run the script with -j" % host + style.RESET)
+                exit(1)
+        for host in sorted(journal_sizes):
+            print "%s: journal size %d MB" % (host, journal_sizes[host])
+            write_host_vars(context, host, {"journal_size": journal_sizes[host]})
+        # group_vars/all gets the smallest size as the cluster-wide default
+        args.osd_journal_size = min(journal_sizes.itervalues())
     else:
         print "osd journal size provided, skipping automatic detection"
         # Verify an actual number was passed in for the variable and pass it in
         # if so
         try:
-            args.osd_journal_size = int
+            args.osd_journal_size = int(args.osd_journal_size)
         except ValueError:
-            print(fore.RED + "deploy.py: ValueError: An integer value was not provided for osd journal size (-j)")
-
-    # Determine public network to use
-    if args.public_network == False:
-        print "Automated public network IP detection is not functional in this release, please re-run the script with the -p and --no-beaker flags."
-        exit(1)
-        # No value provided, so create one based on host addresses
-        # We can ssh to one of the machines here and assume all of the hosts
-        # are on the same network and can communicate with each other
-        #stdin, stdout, stderr = ssh.exec_command("ip route")
-        #output = stdout.read()
+            print(fore.RED + "deploy.py: ValueError: An integer value was not provided for osd journal size (-j)" + style.RESET)
+            exit(1)
+        # Drop per-host sizes detected by a previous run so -j applies
+        for host in context.osd_list:
+            write_host_vars(context, host, {"journal_size": None})
 
-    else:
+    # Determine the public and cluster networks to use
+    if args.public_network:
         print "Public network IP provided, skipping automatic detection"
         # Confirm the user inputted an IP in CIDR notation then pass in the value
         try:
@@ -324,18 +2129,7 @@ def build_playbook():
         except ValueError:
             print(fore.RED + "deploy.py: ValueError: IP Address format was invalid for public network" + style.RESET )
             raise
-
-    # Determine cluster network to use
-    if args.cluster_network == False:
-        print "Automated cluster network IP detection is not functional in this release. \
-        Reverting to public network value provided.  If you would like to specify a cluster network, please re-run the script with the -c and --no-beaker flags."
-        args.cluster_network = "{{ public_network }}"
-
-        # No value provided, so create one based on host addresses
-
-        # Host only has one IP so default back to public network
-
-    else:
+    if args.cluster_network:
         print "Cluster network IP provided, skipping automatic detection"
         # Confirm the user inputted an IP in CIDR notation then pass in the value
         try:
@@ -343,6 +2137,26 @@ def build_playbook():
         except ValueError:
             print(fore.RED + "deploy.py: ValueError: IP Address format was invalid for cluster network" + style.RESET )
             raise
+    if not args.public_network or not args.cluster_network:
+        # No value provided, so pick them from the subnets the hosts share
+        roles = context.roles
+        print "Detecting networks from the addresses of %d host(s)" % len(roles.hosts())
+        public, cluster = detect_networks(context, roles.hosts(), roles.roles['osds'],
+                                          args.public_network or None)
+        if public is None:
+            print (fore.RED + "deploy.py: Error: the hosts do not share a subnet to use as the public network, please re-run the script with -p" + style.RESET)
+            exit(1)
+        if not args.public_network:
+            print "Detected public network %s" % public
+            args.public_network = public
+        if not args.cluster_network:
+            if cluster is None:
+                # The osds only share the public network, so use it for both
+                print "The osd hosts share no subnet besides the public network, using the public network for cluster traffic"
+                args.cluster_network = '"{{ public_network }}"'
+            else:
+                print "Detected cluster network %s" % cluster
+                args.cluster_network = cluster
 
     # cephx true or false
     if args.disable_cephx == True:
@@ -350,94 +2164,727 @@ def build_playbook():
     else:
         cephx_ = "true"
 
-    infile = open('%s/group_vars/all.sample' % (args.directory))
-    outfile = open('%s/group_vars/all' % (args.directory), 'w')
-    replacements = { # Enable RHCS with download from cdn
-                    '#ceph_stable_rh_storage: false':'ceph_stable_rh_storage: true',
-                    '#ceph_stable_rh_storage_cdn_install: false':'ceph_stable_rh_storage_cdn_install: true',
-                     # Specify a OSD journal size, and use the journal size
-                     # from args.osd_journal_size if provided
-                     '#journal_size: 0':'journal_size: %s' % (args.osd_journal_size),
-                     # Specify public/private networks to use
-                     '#public_network: 0.0.0.0/0':'public_network: %s' % (args.public_network),
-                     '#cluster_network: "{{ public_network }}"':'cluster_network: %s' % (args.cluster_network),
-                     # Enable or disable cephx
-                     '#cephx: true':'cephx: %s' % (cephx_)
-                     }
-
-    for line in infile:
-    	for src, target in replacements.iteritems():
-    		line = line.replace(src, target)
-    	outfile.write(line)
-    infile.close()
-    outfile.close()
-
-    # Perform the same thing for group_vars/osds
-    infile = open('%s/group_vars/osds.sample' % (args.directory))
-    outfile = open('%s/group_vars/osds' % (args.directory), 'w')
-    replacements = { # Enable or disable cephx
-                    '#cephx: true':'cephx: %s' % (cephx_),
-                     # Activate the fsid variable since these are baremetal
-                    '#fsid: "{{ cluster_uuid.stdout }}"':'fsid: "{{ cluster_uuid.stdout }}"',
-                     # Set OSD auto discovery
-                    '#osd_auto_discovery: false':'osd_auto_discovery: true',
-                     # Enable journal colocation
-                    '#journal_collocation: false':'journal_collocation: true'
-                     }
-
-    for line in infile:
-    	for src, target in replacements.iteritems():
-    		line = line.replace(src, target)
-    	outfile.write(line)
-    infile.close()
-    outfile.close()
+    settings = { 'journal_size': args.osd_journal_size,
+                 'public_network': args.public_network,
+                 'cluster_network': args.cluster_network,
+                 'cephx': cephx_ }
+    for name, replacements in sorted(GROUP_VARS_TEMPLATES.iteritems()):
+        if not os.path.isfile('%s/group_vars/%s.sample' % (args.directory, name)):
+            continue
+        if render_group_vars(context, name, replacements, settings):
+            print "Wrote group_vars/%s" % name
+        else:
+            print "group_vars/%s is already up to date" % name
 
 """ Ansible deploy """
-# Run the playbook
-def run_playbook():
+# A start of a play/task or a per-host result parsed from ansible-playbook
+# output.  kind is one of 'play', 'task', 'host' or 'recap'.
+PlaybookEvent = namedtuple('PlaybookEvent', 'kind name host status time')
+
+PLAY_RE = re.compile(r'^PLAY \[(.*)\] \*+')
+RECAP_RE = re.compile(r'^PLAY RECAP \*+')
+TASK_RE = re.compile(r'^(?:TASK|NOTIFIED|RUNNING HANDLER):? \[(.*)\] \*+')
+FACTS_RE = re.compile(r'^GATHERING FACTS \*+')
+HOST_RE = re.compile(r'^(ok|changed|skipping|failed|fatal|unreachable): \[([^\]]+)\]')
+
+# Lines of a running process' output as they are written
+def read_lines(stream):
+    for line in iter(stream.readline, ''):
+        yield line
+
+# Copy every line into the playbook log before passing it on
+def tee_log(lines, logger):
+    for line in lines:
+        logger.info(line.rstrip('\n'))
+        yield line
+
+# Turn ansible-playbook output into PlaybookEvents, everything else is dropped
+def parse_playbook_events(lines):
+    for line in lines:
+        now = time.time()
+        match = TASK_RE.match(line)
+        if match:
+            yield PlaybookEvent('task', match.group(1), None, None, now)
+            continue
+        if FACTS_RE.match(line):
+            yield PlaybookEvent('task', 'GATHERING FACTS', None, None, now)
+            continue
+        match = HOST_RE.match(line)
+        if match:
+            yield PlaybookEvent('host', None, match.group(2), match.group(1), now)
+            continue
+        if RECAP_RE.match(line):
+            yield PlaybookEvent('recap', None, None, None, now)
+            continue
+        match = PLAY_RE.match(line)
+        if match:
+            yield PlaybookEvent('play', match.group(1), None, None, now)
+
+# Rotating log file for the full -vvvv playbook output of a deployment
+def playbook_logger(context):
+    log_dir = context.path(LOG_DIR)
+    logger = logging.getLogger("deploy.playbook.%s" % os.path.abspath(log_dir))
+    if not logger.handlers:
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        handler = logging.handlers.RotatingFileHandler(
+            "%s/ansible-playbook.log" % log_dir, maxBytes=10 * 1024 * 1024,
+            backupCount=5)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+# Follows the playbook events, keeping per-task and per-host timings and a
+# live one line summary of where each host is
+class PlaybookProgress(object):
+    def __init__(self, hosts):
+        self.hosts = sorted(hosts)
+        self.counts = dict((host, {'ok': 0, 'changed': 0, 'failed': 0,
+                                   'skipping': 0}) for host in self.hosts)
+        # (task, duration, slowest host, slowest host's duration)
+        self.timings = []
+        self.task = None
+        self.task_start = None
+        self.host_times = {}
+        self.live = sys.stdout.isatty()
+
+    def handle(self, event):
+        if event.kind == 'host':
+            status = {'fatal': 'failed', 'unreachable': 'failed'}.get(event.status, event.status)
+            self.counts.setdefault(event.host, {'ok': 0, 'changed': 0,
+                                                'failed': 0, 'skipping': 0})
+            self.counts[event.host][status] += 1
+            if self.task_start is not None:
+                self.host_times[event.host] = event.time - self.task_start
+            if status == 'failed':
+                self.clear()
+                print (fore.RED + "%s: %s during %s" % (event.host, event.status, self.task) + style.RESET)
+        else:
+            self.finish_task(event.time)
+            if event.kind == 'task':
+                self.task = event.name
+                self.task_start = event.time
+            elif event.kind == 'play':
+                self.clear()
+                print "PLAY [%s]" % event.name
+        self.show()
+
+    def finish_task(self, now):
+        if self.task is not None:
+            slowest = (None, 0)
+            if self.host_times:
+                slowest = max(self.host_times.iteritems(), key=lambda x: x[1])
+            self.timings.append((self.task, now - self.task_start) + slowest)
+        self.task = None
+        self.task_start = None
+        self.host_times = {}
+
+    # One line of per-host progress, redrawn in place on a terminal
+    def show(self):
+        if not self.live or self.task is None:
+            return
+        done = len(self.host_times)
+        failed = sum(1 for counts in self.counts.itervalues() if counts['failed'])
+        line = "[%d/%d hosts, %d failed] %s" % (done, len(self.hosts), failed,
+                                                self.task)
+        sys.stdout.write("\r\033[K" + line[:150])
+        sys.stdout.flush()
+
+    def clear(self):
+        if self.live:
+            sys.stdout.write("\r\033[K")
+            sys.stdout.flush()
+
+    def report(self, limit=10):
+        self.clear()
+        print (fore.LIGHT_BLUE + style.BOLD + "\nPer-host results" + style.RESET)
+        for host in self.hosts:
+            counts = self.counts[host]
+            print "%-40s ok=%-4d changed=%-4d skipped=%-4d failed=%d" % (
+                host, counts['ok'], counts['changed'], counts['skipping'],
+                counts['failed'])
+        print (fore.LIGHT_BLUE + style.BOLD + "\nSlowest tasks" + style.RESET)
+        slowest = sorted(self.timings, key=lambda x: x[1], reverse=True)
+        for task, duration, host, host_duration in slowest[:limit]:
+            if host is not None:
+                print "%8.1fs  %s (slowest host %s: %.1fs)" % (duration, task, host, host_duration)
+            else:
+                print "%8.1fs  %s" % (duration, task)
+
+# Run the playbook, streaming its output into the log and the progress summary
+@profiled("run_playbook")
+def run_playbook(context):
     # Reference the correct site.yml
-    ansiblePlaybook = "%s/site.yml" % (args.directory)
-    ansible_run = [ '/usr/bin/ansible',
-              "ansible-playbook",
+    ansiblePlaybook = "%s/site.yml" % (context.args.directory)
+    log_dir = context.path(LOG_DIR)
+    ansible_run = [ "ansible-playbook",
               "-vvvv",
               "--user=root",
-              "-i", "ansible_hosts",
+              "-i", context.path("ansible_hosts"),
               "%s" % ansiblePlaybook ]
-    ansible_run_ = Popen(bkr_args, stdout=PIPE, stderr=STDOUT)
-    ansible_run_.wait()
+    if context.playbook_limit is not None:
+        ansible_run.append("--limit=%s" % ",".join(context.playbook_limit))
+    print (fore.LIGHT_BLUE + style.BOLD + "\nRunning %s, the full output is logged to %s/ansible-playbook.log" % (ansiblePlaybook, log_dir) + style.RESET)
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    # Each deployment of a --manifest run has its own ansible.cfg
+    if 'ansible_cfg' in context.profile.settings:
+        env["ANSIBLE_CONFIG"] = os.path.abspath(context.path(ANSIBLE_CFG))
+    profile_count('subprocesses')
+    ansible_run_ = Popen(ansible_run, stdout=PIPE, stderr=STDOUT, env=env)
+    playbook_hosts = context.playbook_limit or context.roles.hosts()
+    context.profile.settings['playbook_hosts'] = len(playbook_hosts)
+    progress = PlaybookProgress(playbook_hosts)
+    start = time.time()
+    # Reading the pipe as it is written keeps a verbose run from filling it
+    # and blocking ansible
+    events = parse_playbook_events(tee_log(read_lines(ansible_run_.stdout),
+                                           playbook_logger(context)))
+    for event in events:
+        progress.handle(event)
+    progress.finish_task(time.time())
+    returncode = ansible_run_.wait()
+    progress.report()
+    previous = previous_playbook_run(context)
+    print "\nansible-playbook finished in %.1f seconds for %d host(s) with %s" % (time.time() - start, len(playbook_hosts), describe_ansible_cfg(context.profile.settings))
+    if previous is not None:
+        path, profile = previous
+        print "The previous run took %.1f seconds for %s host(s) with %s (%s)" % (
+            profile['stages']['run_playbook']['wall'],
+            profile['settings'].get('playbook_hosts', "?"),
+            describe_ansible_cfg(profile['settings']), path)
+    if returncode != 0:
+        print (fore.RED + "deploy.py: Error: ansible-playbook exited with status %d, see %s/ansible-playbook.log" % (returncode, log_dir) + style.RESET)
+        exit(1)
 
-def main():
-    # Define globals
-    global args, inventory, mon_list, osd_list, beaker_hosts, beaker_host_list
-    global ansibleInventory, beakerPassword, subscriptionUsername, subscriptionPassword
+# Describe the ansible.cfg settings recorded in a run profile
+def describe_ansible_cfg(settings):
+    cfg = settings.get('ansible_cfg')
+    if not cfg:
+        return "the ansible defaults"
+    return "the generated ansible.cfg (%d forks, pipelining, fact cache)" % cfg['forks']
 
+# The newest saved run profile of the deployment which ran the playbook, as
+# (path, profile)
+def previous_playbook_run(context):
+    for path in reversed(sorted(glob.glob("%s/*.json" % context.profile.directory))):
+        try:
+            with open(path) as f:
+                profile = json.load(f)
+        except (IOError, ValueError):
+            continue
+        if 'run_playbook' in profile['stages']:
+            profile.setdefault('settings', {})
+            return path, profile
+    return None
+
+""" Deployment checkpoints """
+# Fingerprint of the inputs a stage depends on, a stage is only considered
+# done on --resume if its inputs have not changed since it last completed
+def fingerprint(*values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+# Fingerprint of a file's contents, None if it doesn't exist
+def file_fingerprint(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Records which stages finished, and with which input fingerprint, in
+# STATE_FILE as the run progresses.  Without resume the previous state is
+# discarded and everything runs again.  Stages depending on passwords are
+# fingerprinted with an HMAC keyed by a random secret kept in the state, which
+# is only readable by the user.
+class DeployState(object):
+    def __init__(self, path, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.secret = None
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.stages = state.get("stages", {})
+            self.secret = state.get("secret")
+        if self.secret is None:
+            self.secret = os.urandom(20).encode("hex")
+
+    # Fingerprint of inputs including passwords
+    def secret_fingerprint(self, *values):
+        return hmac.new(str(self.secret), json.dumps(values, sort_keys=True),
+                        hashlib.sha1).hexdigest()
+
+    def done(self, name, stage_fingerprint):
+        return (stage_fingerprint is not None and
+                self.stages.get(name) == stage_fingerprint)
+
+    def record(self, name, stage_fingerprint):
+        with self.lock:
+            self.stages[name] = stage_fingerprint
+            atomic_write(self.path, json.dumps({"secret": self.secret,
+                                                "stages": self.stages},
+                                               indent=2, sort_keys=True),
+                         mode=0600)
+
+""" Stage scheduling """
+# Runs the deploy stages as a dependency graph.  A stage starts as soon as
+# every stage it depends on has finished, so each host moves through its own
+# stages independently and host-independent stages overlap with them.
+# Stages added without a function are marked done from elsewhere with
+# complete().  Stages with a fingerprint are checkpointed in state and
+# skipped when state already has them done, as long as no checkpointed stage
+# they depend on has to run again.  Stages without a fingerprint always run.
+# Once a stage fails no new stages are started, stopping is set for long
+# running stages to check and the stages already running are waited for.
+class StageScheduler(object):
+    def __init__(self, workers, state):
+        self.workers = workers
+        self.state = state
+        self.stages = OrderedDict()
+        self.skipped = set()
+        self.results = {}
+        self.events = Queue.Queue()
+        self.stopping = threading.Event()
+
+    def add(self, name, func=None, deps=(), fingerprint=None):
+        self.stages[name] = (func, list(deps), fingerprint)
+
+    # Thread safe, may be called from inside a running stage
+    def complete(self, name):
+        self.events.put((name, None))
+
+    # True if the stage was skipped because it is already checkpointed
+    def is_skipped(self, name):
+        return name in self.skipped
+
+    # How a stage ended: ok, failed, resumed or not run
+    def status(self, name):
+        if name in self.skipped:
+            return 'resumed'
+        return self.results.get(name, 'not run')
+
+    def _run_stage(self, name, func):
+        try:
+            func()
+        except BaseException as e:
+            self.events.put((name, e))
+        else:
+            self.events.put((name, None))
+
+    # Stages are added after their dependencies, so a single pass in order is
+    # enough to find every checkpointed stage that can be skipped
+    def _find_skipped(self):
+        self.skipped = set()
+        for name, (func, deps, stage_fingerprint) in self.stages.iteritems():
+            if (self.state.done(name, stage_fingerprint) and
+                    all(dep in self.skipped or self.stages[dep][2] is None
+                        for dep in deps)):
+                self.skipped.add(name)
+
+    # Run every stage, returns the name of the first stage that failed or
+    # None once all of them are done.  Returns only when no stage is running.
+    def run(self):
+        self._find_skipped()
+        if self.skipped:
+            print "Resuming, skipping %d stage(s) completed by a previous run" % len(self.skipped)
+        waiting = {}
+        dependents = dict((name, []) for name in self.stages)
+        for name, (func, deps, stage_fingerprint) in self.stages.iteritems():
+            waiting[name] = len([dep for dep in deps if dep not in self.skipped])
+            for dep in deps:
+                dependents[dep].append(name)
+        ready = deque(name for name, count in waiting.iteritems()
+                      if count == 0 and name not in self.skipped and
+                      self.stages[name][0] is not None)
+        running = set()
+        remaining = set(self.stages) - self.skipped
+        failed = None
+        while remaining and (failed is None or running):
+            while failed is None and ready and len(running) < self.workers:
+                name = ready.popleft()
+                running.add(name)
+                thread = threading.Thread(target=self._run_stage,
+                                          args=(name, self.stages[name][0]))
+                thread.daemon = True
+                thread.start()
+            if not running:
+                # Nothing left that could complete the external stages
+                return sorted(remaining)[0]
+            try:
+                # Poll so KeyboardInterrupt is still delivered
+                name, error = self.events.get(True, 1)
+            except Queue.Empty:
+                continue
+            if error is not None:
+                if not isinstance(error, SystemExit):
+                    print (fore.RED + "deploy.py: %s: %s" % (name, error) + style.RESET)
+                self.results[name] = 'failed'
+                running.discard(name)
+                if failed is None:
+                    failed = name
+                    self.stopping.set()
+                    if running:
+                        print "Waiting for %d running stage(s) to finish" % len(running)
+                continue
+            if name not in remaining:
+                continue
+            if self.stages[name][2] is not None:
+                self.state.record(name, self.stages[name][2])
+            self.results[name] = 'ok'
+            running.discard(name)
+            remaining.discard(name)
+            if failed is not None:
+                continue
+            for dependent in dependents[name]:
+                waiting[dependent] -= 1
+                if (waiting[dependent] == 0 and dependent in remaining and
+                        self.stages[dependent][0] is not None):
+                    ready.append(dependent)
+        return failed
+
+# Lay out the deployment as stages.  Each host is reserved, keyed and
+# subscribed on its own schedule while the inventory, known_hosts and, when
+# no remote probing is needed, the playbook variables are prepared alongside.
+def plan_stages(context, public_key, state):
+    args = context.args
+    roles = context.roles
+    scheduler = StageScheduler(args.ssh_workers + 2, state)
+    hosts = sorted(context.beaker_host_list)
+    reserved = dict((host, []) for host in hosts)
+    if args.no_beaker == False:
+        # Only hosts without a checkpointed reservation are sent to beaker
+        scheduler.add("beaker", lambda: beaker_reserve(
+            context,
+            [host for host in hosts
+             if not scheduler.is_skipped("reserve:%s" % host)],
+            lambda host: scheduler.complete("reserve:%s" % host),
+            scheduler.stopping))
+        for host in hosts:
+            scheduler.add("reserve:%s" % host,
+                          fingerprint=fingerprint(host))
+            reserved[host] = ["reserve:%s" % host]
+    scheduler.add("inventory", lambda: write_inventory(context))
+    scheduler.add("known_hosts", lambda: prune_known_hosts(context))
+    for host in hosts:
+        scheduler.add("key:%s" % host,
+                      lambda host=host: deploy_key(context, host, public_key),
+                      reserved[host] + ["known_hosts"],
+                      state.secret_fingerprint(host, public_key,
+                                               context.beaker_password))
+        scheduler.add("subscribe:%s" % host,
+                      lambda host=host: subscribe_host(context, host),
+                      reserved[host],
+                      state.secret_fingerprint(host, context.subscription_username,
+                                               context.subscription_password))
+    scheduler.add("ping", lambda: ansible_ping(context),
+                  ["inventory"] + ["key:%s" % host for host in hosts])
+    playbook_deps = ["ping"] + ["subscribe:%s" % host for host in hosts]
+    if args.no_ansible == False:
+        # Journal sizing has to wait for the osds to be up and network
+        # detection for every host, everything else in build_playbook() is
+        # local
+        vars_deps = []
+        if not args.public_network or not args.cluster_network:
+            for host in hosts:
+                vars_deps.extend(reserved[host])
+        elif not args.osd_journal_size:
+            for host in context.osd_list:
+                vars_deps.extend(reserved.get(host, []))
+        scheduler.add("playbook_vars", lambda: build_playbook(context), vars_deps,
+                      fingerprint(roles.as_dict(), args.osd_journal_size,
+                                  args.public_network, args.cluster_network,
+                                  args.disable_cephx,
+                                  [file_fingerprint("%s/group_vars/%s.sample" % (args.directory, name))
+                                   for name in sorted(GROUP_VARS_TEMPLATES)]))
+        playbook_deps.append("playbook_vars")
+    scheduler.add("playbook", lambda: run_playbook(context), playbook_deps,
+                  fingerprint(roles.as_dict(), roles.host_vars,
+                              file_fingerprint("%s/site.yml" % args.directory)))
+    return scheduler
+
+""" Deployment setup """
+# Fill in the arguments missing from the command line from a section of a
+# ConfigStore, its global options apply to every section
+def fill_args(args, store, section):
+    for option, dest in CONFIG_ARGS.items():
+        value = store.get(option, env=section)
+        if getattr(args, dest) is None and value is not None:
+            setattr(args, dest, store.format(value))
+
+# Work out the hosts and roles of one deployment from its arguments and check
+# them.  Returns None if an --expand has nothing to add.  Errors are reported
+# through error(), parser.error for a single deployment.
+def build_context(parser, config, name, args, workdir=".", error=None):
+    error = error or parser.error
+    context = DeployContext(name, args, workdir)
+    # Options missing from the command line come from the environment profile
+    if args.env is not None:
+        if args.env not in config.environments():
+            print (fore.RED + "deploy.py: Error: there is no [%s] environment in %s, the available ones are: %s" % (args.env, CONFIG_FILE, ", ".join(config.environments()) or "none") + style.RESET)
+            exit(1)
+        fill_args(args, config, args.env)
+    # Map the hosts given on the command line and in --roles-file to roles
+    roles = InventoryBuilder()
+    if args.roles_file is not None:
+        try:
+            read_roles_file(args.roles_file, roles)
+        except (IOError, ValueError) as e:
+            print (fore.RED + "deploy.py: Error: unable to read the roles file: %s" % e + style.RESET)
+            exit(1)
+    for role in INVENTORY_ROLES:
+        for host in (getattr(args, role) or "").split(","):
+            if host.strip():
+                roles.add(role, host.strip())
+    requested = roles.hosts()
+
+    # Only the hosts missing from the existing inventory are worked on when
+    # expanding, the playbook is limited to them and the mons
+    if args.expand:
+        inventory_path = context.path('ansible_hosts')
+        if not os.path.isfile(inventory_path):
+            print (fore.RED + "deploy.py: Error: --expand needs the ansible_hosts of an existing deployment in %s" % (workdir if workdir != "." else "the current directory") + style.RESET)
+            exit(1)
+        existing = InventoryBuilder()
+        try:
+            read_roles_file(inventory_path, existing)
+        except ValueError as e:
+            print (fore.RED + "deploy.py: Error: unable to read %s: %s" % (inventory_path, e) + style.RESET)
+            exit(1)
+        roles, added, changed = merge_inventory(existing, roles)
+        if not changed:
+            print "Every requested host already has its roles in %s, nothing to expand." % inventory_path
+            return None
+        context.playbook_limit = list(OrderedDict.fromkeys(changed + roles.roles['mons']))
+    else:
+        added = changed = roles.hosts()
+
+    for option, value in (("-m/--mons", roles.roles['mons']), ("-o/--osds", roles.roles['osds']),
+                          ("-d/--ansible-directory", args.directory)):
+        if not value:
+            error("argument %s is required" % option)
+
+    # Verify FQDNs have been passed for every role
+    context.roles = roles
+    context.mon_list = roles.roles['mons']
+    context.osd_list = [host for host in roles.roles['osds'] if host in changed]
+    context.beaker_host_list = set(added)
+    if args.expand:
+        # The cluster keeps the networks and default journal size it was
+        # deployed with, only new osds get their journal sized
+        deployed = read_group_vars(context, "all")
+        for option in ("public_network", "cluster_network"):
+            if not getattr(args, option) and deployed.get(option):
+                setattr(args, option, deployed[option])
+        if not args.osd_journal_size and not context.osd_list:
+            if not deployed.get("journal_size"):
+                print (fore.RED + "deploy.py: Error: no new osds to size the journal from and %s/group_vars/all has no journal_size, please re-run the script with -j" % args.directory + style.RESET)
+                exit(1)
+            args.osd_journal_size = deployed["journal_size"]
+    for each in requested:
+        if is_valid_hostname(each) == False:
+            print (fore.RED + "deploy.py: Error: The provided host: %s does not appear to be a valid FQDN or IP address." % each)
+            exit(1)
+    return context
+
+# Build a context per [section] of the --manifest file.  The command line
+# applies to every cluster and wins over the manifest, whose options before
+# the first [section] are shared by the clusters.
+def read_manifest(parser, args, config):
+    for role in INVENTORY_ROLES + ('roles_file',):
+        if getattr(args, role) is not None:
+            parser.error("the hosts of each cluster come from the manifest, they can't be given with --manifest")
+    if not os.path.isfile(args.manifest):
+        parser.error("the manifest %s does not exist" % args.manifest)
+    manifest = ConfigStore(args.manifest)
+    if not manifest.environments():
+        parser.error("the manifest %s has no [cluster] sections" % args.manifest)
+    contexts = []
+    workdirs = {}
+    directories = {}
+    owners = {}
+    for name in manifest.environments():
+        cluster_args = argparse.Namespace(**vars(args))
+        if cluster_args.env is None:
+            cluster_args.env = manifest.get("env", env=name)
+        fill_args(cluster_args, manifest, name)
+        workdir = manifest.get("workdir", env=name, default=os.path.join("extras", "clusters", name))
+        if os.path.abspath(workdir) in workdirs:
+            parser.error("clusters %s and %s share the workdir %s" % (workdirs[os.path.abspath(workdir)], name, workdir))
+        workdirs[os.path.abspath(workdir)] = name
+        context = build_context(parser, config, name, cluster_args, workdir,
+                                lambda message, name=name: parser.error("[%s] %s" % (name, message)))
+        if context is None:
+            continue
+        # Each cluster's group_vars and host_vars are written to its playbook
+        directory = os.path.abspath(cluster_args.directory)
+        if directory in directories and not args.no_ansible:
+            parser.error("clusters %s and %s share the ansible directory %s, each cluster needs a copy of ceph-ansible" % (directories[directory], name, cluster_args.directory))
+        directories[directory] = name
+        for host in context.roles.hosts():
+            if host in owners:
+                parser.error("%s is in both the %s and %s clusters" % (host, owners[host], name))
+            owners[host] = name
+        contexts.append(context)
+    return contexts
+
+""" Deployment runs """
+# Report how far every host got through key distribution and subscription
+def report_hosts(context, scheduler):
+    if not context.beaker_host_list:
+        return
+    print (fore.LIGHT_BLUE + style.BOLD + "\nHost summary" + style.RESET)
+    for host in sorted(context.beaker_host_list):
+        key = scheduler.status("key:%s" % host)
+        subscribe = scheduler.status("subscribe:%s" % host)
+        if 'failed' in (key, subscribe):
+            color = fore.RED
+        elif 'not run' in (key, subscribe):
+            color = ""
+        else:
+            color = fore.GREEN
+        print (color + "%-40s key %-8s subscription %s" % (host, key, subscribe) + style.RESET)
+
+# Run the stages of one deployment, returns the name of the stage that failed
+# or None
+def run_deployment(context, public_key):
+    # Reserve, key and subscribe each host as soon as it is ready, then
+    # ping, edit and run the playbook
+    if context.args.expand:
+        print (fore.LIGHT_BLUE + style.BOLD + "\nExpanding the cluster with %d new host(s), the playbook is limited to %s" % (len(context.beaker_host_list), ",".join(context.playbook_limit)) + style.RESET)
+    else:
+        print (fore.LIGHT_BLUE + style.BOLD + "\nDeploying %d host(s)" % len(context.beaker_host_list) + style.RESET)
+    try:
+        state = DeployState(context.path(STATE_FILE), context.args.resume)
+        scheduler = plan_stages(context, public_key, state)
+        failed = scheduler.run()
+        report_hosts(context, scheduler)
+        return failed
+    finally:
+        print "Run profile written to %s" % context.profile.save()
+
+# Prefixes every line written while a thread works on a deployment of a
+# --manifest run with the name of its cluster, so the interleaved output of
+# the clusters stays readable.  Lines are buffered per thread until complete.
+class PrefixedOutput(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.softspace = 0
+
+    def write(self, data):
+        context = current_context()
+        if context is None:
+            with self.lock:
+                self.stream.write(data)
+            return
+        lines = (getattr(self.local, 'partial', "") + data).split("\n")
+        self.local.partial = lines.pop()
+        if lines:
+            with self.lock:
+                self.stream.write("".join("[%s] %s\n" % (context.name, line)
+                                          for line in lines))
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    # The live progress line redraws itself, which interleaves badly
+    def isatty(self):
+        return False
+
+# Deploy every cluster of a --manifest at once, each in its own thread and
+# with its own scheduler, then summarize them.  Returns True if any failed.
+def run_manifest(contexts, public_key):
+    results = {}
+    def deploy(context):
+        thread_state.context = context
+        start = time.time()
+        try:
+            failed = run_deployment(context, public_key)
+        except BaseException as e:
+            if not isinstance(e, SystemExit):
+                print (fore.RED + "deploy.py: %s" % e + style.RESET)
+            failed = "setup"
+        results[context.name] = (failed, time.time() - start)
+    print (fore.LIGHT_BLUE + style.BOLD + "\nDeploying %d cluster(s) from %s" % (len(contexts), contexts[0].args.manifest) + style.RESET)
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout)
+    try:
+        threads = []
+        for context in contexts:
+            thread = threading.Thread(target=deploy, args=(context,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Join with a timeout so KeyboardInterrupt is still delivered
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        sys.stdout = stdout
+    print (fore.LIGHT_BLUE + style.BOLD + "\nCluster summary" + style.RESET)
+    failures = 0
+    for context in contexts:
+        failed, elapsed = results.get(context.name, ("interrupted", 0))
+        if failed is None:
+            outcome = fore.GREEN + "deployed" + style.RESET
+        else:
+            outcome = fore.RED + "failed in %s" % failed + style.RESET
+            failures += 1
+        print "%-20s %4d host(s) %8.1fs  %-30s %s" % (context.name, len(context.roles.hosts()), elapsed, context.workdir, outcome)
+    if failures:
+        print (fore.RED + "deploy.py: Error: %d of %d cluster(s) failed, see the output above and their workdirs for details.  Re-run with --resume to skip the stages which completed" % (failures, len(contexts)) + style.RESET)
+    return failures > 0
+
+def main():
     # Provide command line arguments
     parser = argparse.ArgumentParser(description="Deploy test environments for Ceph \
                                     inside of beaker by piggybacking off of \
                                     ceph-ansible playbooks.")
+    # -m, -o, -d and -p are required for deployments, they are checked after
+    # parsing so --profile-report can be used on its own
     parser.add_argument("-m",
                         "--mons",
-                        required=True,
                         dest="mons",
                         help="Define comma-delimited FQDNs where ceph-mons should \
                         be configured.  (Ex. ceph2.example.com,ceph3.example.com)")
     parser.add_argument("-o",
                         "--osds",
-                        required=True,
                         dest="osds",
                         help="Define comma-delimited FQDNs where ceph-osds should \
                         be configured. (Ex. ceph2.example.com,ceph3.example.com)")
-    #FIXME: Disabled until we add the required setup tasks for this option
-    #parser.add_argument("-r",
-    #                    "--rgws",
-    #                    dest="rgws",
-    #                    help="Define comma-delimited FQDNs where a radosgw should \
-    #                    be configured. (Ex. ceph2.example.com,ceph3.example.com)")
+    parser.add_argument("-r",
+                        "--rgws",
+                        dest="rgws",
+                        help="Define comma-delimited FQDNs where a radosgw should \
+                        be configured. (Ex. ceph2.example.com,ceph3.example.com)")
+    parser.add_argument("--mdss",
+                        dest="mdss",
+                        help="Define comma-delimited FQDNs where a ceph-mds should \
+                        be configured.")
+    parser.add_argument("--restapis",
+                        dest="restapis",
+                        help="Define comma-delimited FQDNs where the ceph-rest-api \
+                        should be configured.")
+    parser.add_argument("--clients",
+                        dest="clients",
+                        help="Define comma-delimited FQDNs which should be set up \
+                        as ceph clients.")
+    parser.add_argument("--roles-file",
+                        dest="roles_file",
+                        help="Read the hosts of each role from an ansible INI style \
+                        file with a [mons], [osds], [mdss], [rgws], [restapis] or \
+                        [clients] section per role.  option=value pairs after a \
+                        host become its inventory variables.  Hosts given with \
+                        -m, -o, -r, --mdss, --restapis and --clients are added \
+                        to the ones in the file.")
     parser.add_argument("-d",
                         "--ansible-directory",
                         #FIXME: 'required = True' should not be set when
                         # '--no-ansible' is used.
-                        required = True,
                         dest="directory",
                         help="Specify the location the ceph-ansible directory \
                         resides.  It's best to utilize a secondary ceph-ansible \
@@ -457,94 +2904,208 @@ def main():
                         beaker. This option should only be used if the hosts are \
                         either not beaker machines OR have previously been reserved in \
                         beaker using a different method.")
+    parser.add_argument("--beaker-workers",
+                        dest="beaker_workers",
+                        type=int,
+                        default=10,
+                        help="Maximum number of beaker jobs to submit or poll \
+                        at the same time. (Default: 10)")
+    parser.add_argument("--beaker-poll-interval",
+                        dest="beaker_poll_interval",
+                        type=int,
+                        default=15,
+                        help="Initial number of seconds to wait between beaker \
+                        job status checks.  The interval backs off while no \
+                        job changes state. (Default: 15)")
+    parser.add_argument("--ssh-workers",
+                        dest="ssh_workers",
+                        type=int,
+                        default=20,
+                        help="Maximum number of hosts to contact over ssh at the \
+                        same time. (Default: 20)")
+    parser.add_argument("--ssh-timeout",
+                        dest="ssh_timeout",
+                        type=int,
+                        default=30,
+                        help="Number of seconds to wait on a single host's ssh \
+                        connection or command. (Default: 30)")
+    parser.add_argument("--ssh-retries",
+                        dest="ssh_retries",
+                        type=int,
+                        default=2,
+                        help="Number of times to retry hosts which failed an ssh \
+                        operation. (Default: 2)")
+    parser.add_argument("--ssh-backend",
+                        dest="ssh_backend",
+                        choices=sorted(SSH_BACKENDS),
+                        default="paramiko",
+                        help="How remote commands are run: a paramiko session \
+                        and thread per host, or the openssh cli driven from a \
+                        single event loop, which scales to hundreds of hosts. \
+                        (Default: paramiko)")
+    parser.add_argument("--ping-forks",
+                        dest="ping_forks",
+                        type=int,
+                        default=100,
+                        help="Maximum number of hosts the ansible ping module \
+                        contacts at the same time. (Default: 100)")
+    parser.add_argument("--ping-timeout",
+                        dest="ping_timeout",
+                        type=int,
+                        default=10,
+                        help="Number of seconds to wait for a host to answer the \
+                        ansible ping before it counts as unreachable.  \
+                        Unreachable hosts are retried --ssh-retries times. \
+                        (Default: 10)")
+    parser.add_argument("--refresh-cache",
+                        action="store_true",
+                        dest="refresh_cache",
+                        help="Ignore hardware details cached in extras/cache by \
+                        previous runs and probe the hosts again.")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        dest="resume",
+                        help="Skip the stages a previous run completed for each \
+                        host, as recorded in extras/deploy.state.  Stages whose \
+                        inputs (hosts, configuration, playbook samples) changed \
+                        since are run again.")
     parser.add_argument("-j",
                         "--journal-size",
                         dest="osd_journal_size",
                         help="Specify the size in MB to be used when creating the \
                         OSD journal during initial OSD setup.  If no size is \
-                        specified it will be calculated from one of the OSD hosts \
-                        supplied.")
+                        specified it will be calculated for each OSD host from \
+                        its largest disk.")
     parser.add_argument("-c",
                         "--cluster-network",
                         dest="cluster_network",
-                        # TODO: Will require for now until automated detection
-                        # is implemented.
                         help="Specify the cluster network address in CIDR notation \
                         to be used for back-end cluster communication.  If none is \
-                        supplied and the host(s) selected have more then one \
-                        interface the cluster and public networks will be selected \
-                        automatically (not functional in this release, this flag is required). If the host(s) only have one network, only \
+                        supplied it is detected as the subnet shared by every osd \
+                        host other than the public network, preferring the fastest \
+                        links.  If the osd host(s) share no other network, only \
                         a public network will be configured.")
     parser.add_argument("-p",
                         "--public-network",
                         dest="public_network",
-                        # TODO: Will require for now until automated detection
-                        # is implemented.
-                        required=True,
                         help="Specify the public network address in CIDR notation \
                         to be used for public, front-end  cluster communication.  \
-                        If none is supplied and the host(s) selected have more \
-                        then one interface the cluster and public networks will be \
-                        selected automatically. (not functional in this release, this flag is required).")
+                        If none is supplied it is detected as the subnet shared \
+                        by every host, preferring the one carrying their default \
+                        route.")
+    parser.add_argument("--env",
+                        dest="env",
+                        help="Name of a [section] in extras/deploy.cfg holding an \
+                        environment profile.  Its role (mons, osds, mdss, rgws, \
+                        restapis, clients), roles_file, directory, journal_size, \
+                        public_network and cluster_network options fill in the flags not given on the command line, and \
+                        its passwords override the global ones.")
     parser.add_argument("--disable-cephx",
                         action="store_true",
                         dest="disable_cephx",
                         help="Do not enable cephx authentication.")
-    #TODO: add expansion arguments to support in place cluster expansions.
-    ## Most likely, we'll need to negate the required=True for mons/osds and make
-    ## only one required.
+    parser.add_argument("--profile-report",
+                        nargs="*",
+                        dest="profile_report",
+                        metavar="PROFILE",
+                        help="Compare the stage timings of run profiles saved in \
+                        extras/profiles (by default the two most recent runs) \
+                        and exit.")
+    parser.add_argument("--ansible-defaults",
+                        action="store_true",
+                        dest="ansible_defaults",
+                        help="Run ansible with its default settings instead of \
+                        the ansible.cfg generated in extras/ansible.cfg, e.g. to \
+                        compare timings.")
+    parser.add_argument("--expand",
+                        action="store_true",
+                        dest="expand",
+                        help="Add the given hosts to the cluster in ansible_hosts \
+                        instead of deploying a new one.  Only the hosts which \
+                        are not in ansible_hosts yet are reserved, keyed and \
+                        subscribed, and the playbook is limited to the hosts \
+                        which gained a role plus the mons.")
+
+    parser.add_argument("--preflight-timeout",
+                        dest="preflight_timeout",
+                        type=int,
+                        default=2,
+                        help="Number of seconds the pre-flight check waits for \
+                        the DNS answers of every host, and again for the hosts \
+                        which are not being reserved to answer on the ssh port. \
+                        (Default: 2)")
+    parser.add_argument("--skip-preflight",
+                        action="store_true",
+                        dest="skip_preflight",
+                        help="Do not check that every host resolves, that no two \
+                        hosts are the same machine and that the hosts which are \
+                        not being reserved answer on the ssh port before starting.")
+    parser.add_argument("--manifest",
+                        dest="manifest",
+                        help="Deploy several independent clusters at once.  The \
+                        manifest has a [section] per cluster holding the same \
+                        options as an environment profile, plus env to take \
+                        the passwords and defaults of a deploy.cfg profile and \
+                        workdir for the cluster's ansible_hosts, state, logs \
+                        and profiles (Default: extras/clusters/<name>).  The \
+                        beaker and ssh worker limits are shared by every cluster.")
 
     args = parser.parse_args()
 
-    # Verify FQDNs have been passed to -m, -o
-    mon_list = args.mons.split(",")
-    osd_list = args.osds.split(",")
-    beaker_hosts = args.mons + "," + args.osds
-    beaker_host_list = set(beaker_hosts.split(","))
-    for each in beaker_host_list:
-        if is_valid_hostname(each) == False:
-            print (fore.RED + "deploy.py: Error: The provided host: %s does not appear to be a valid FQDN or IP address." % each)
-            exit(1)
+    if args.profile_report is not None:
+        profile_report(args.profile_report)
+        exit(0)
 
-    # Build localized config if it doesn't exist
     """ Build a local config for some user secrets """
-    config_file = "extras/deploy.cfg"
-    config = load_config(config_file)
+    config = ConfigStore(CONFIG_FILE)
+    if args.manifest is not None:
+        contexts = read_manifest(parser, args, config)
+    else:
+        contexts = [build_context(parser, config, "", args)]
+    contexts = [context for context in contexts if context is not None]
+    if not contexts:
+        exit(0)
 
-    # Config file variables
-    # subscription-manager username
-    if not ("subscriptionUsername" and "subscriptionPassword" and "beakerPassword" in config) or not (os.path.isfile('extras/deploy.cfg')):
-        print (fore.LIGHT_BLUE + style.BOLD + "Detected that some configuration variables may not exist in the extras/deploy.cfg file, creating them now."
+    # Reject unknown, duplicate and unreachable hosts before asking for
+    # anything or reserving them
+    if args.skip_preflight == False:
+        preflight(contexts, args.preflight_timeout)
+
+    # Ask for the config variables missing from extras/deploy.cfg
+    envs = set(context.args.env for context in contexts)
+    if not all(config.get(option, env=env) for option in
+               ("subscriptionUsername", "subscriptionPassword", "beakerPassword")
+               for env in envs):
+        print (fore.LIGHT_BLUE + style.BOLD + "Detected that some configuration variables may not exist in the %s file, creating them now." % CONFIG_FILE
         + style.RESET)
 
-    if not "subscriptionUsername" in config:
-        subscriptionUsername = question("string","Enter subscription-manager username")
-        save_config(config_file, "subscriptionUsername",subscriptionUsername)
+    # subscription-manager username
+    if not all(config.get("subscriptionUsername", env=env) for env in envs):
+        config.set("subscriptionUsername", question("string","Enter subscription-manager username"))
 
     # subscription-manager password
-    if not "subscriptionPassword" in config:
-        subscriptionPassword = getpass.getpass('Enter subscription-manager password: ')
-        save_config(config_file, "subscriptionPassword",subscriptionPassword)
+    if not all(config.get("subscriptionPassword", env=env) for env in envs):
+        config.set("subscriptionPassword", getpass.getpass('Enter subscription-manager password: '))
 
     # beaker password
-    if not "beakerPassword" in config:
-        beakerPassword = question("string","""Specify the beaker root password,
+    if not all(config.get("beakerPassword", env=env) for env in envs):
+        config.set("beakerPassword", question("string","""Specify the beaker root password,
         which can be found in user preferences on the beaker website.  This is used
         to configure keyless SSH for ansible access to the hosts.  If you are not
         using beaker, simply specify the root password of the hosts (the passwords
-        should all be in common)""")
-        save_config(config_file, "beakerPassword",beakerPassword)
+        should all be in common)"""))
 
-    # Reload configurations to pull in the new settings
-    config = load_config(config_file)
+    # Write the new settings out in one go
+    config.flush()
 
     # Set variables
-    subscriptionUsername = config["subscriptionUsername"]
-    subscriptionPassword = config["subscriptionPassword"]
-    beakerPassword = config["beakerPassword"]
+    for context in contexts:
+        context.subscription_username = config.get("subscriptionUsername", env=context.args.env)
+        context.subscription_password = config.get("subscriptionPassword", env=context.args.env)
+        context.beaker_password = config.get("beakerPassword", env=context.args.env)
 
-    # Create an empty ansible_hosts file if it doesn't exist
-    create_ansiblehosts()
+    # Interactive and local checks happen up front, before any stage starts
+    public_key = read_public_key()
 
     # Don't run beakerReserve() if --no-beaker is set
     if args.no_beaker == True:
@@ -552,28 +3113,33 @@ def main():
         + style.RESET)
         print "Skipping beaker reservation"
     else:
-        beaker_reserve()
-
-    # Generate Ansible prerequisites
-    generate_prereqs()
-
-    # Issue an ansible ping command
-    ansibleInventory = Inventory(host_list='ansible_hosts')
-    ansible_ping()
-
-    # Subscribe hosts to the correct repos
-    subscribe_hosts()
+        beaker_kinit(contexts[0])
 
     # Build the playbook, unless --no-ansible is set
     if args.no_ansible == True:
         print (fore.LIGHT_BLUE + style.BOLD + "\nno-ansible flag detected"
         + style.RESET)
         print "Skipping automated Ansible playbook editing"
-    else:
-        build_playbook()
 
-    # Run the ansible playbook
-    run_playbook()
+    # One set of ssh sessions and bkr slots shared by every remote step of
+    # every cluster
+    ssh_pool = SSH_BACKENDS[args.ssh_backend](args.ssh_workers, args.ssh_timeout)
+    beaker_slots = threading.BoundedSemaphore(args.beaker_workers)
+    for context in contexts:
+        context.ssh_pool = ssh_pool
+        context.beaker_slots = beaker_slots
+        ssh_pool.add_hosts(context.roles.hosts(), context.beaker_password)
+    try:
+        if args.manifest is not None:
+            if run_manifest(contexts, public_key):
+                exit(1)
+        else:
+            failed = run_deployment(contexts[0], public_key)
+            if failed is not None:
+                print (fore.RED + "deploy.py: Error: the %s stage failed, see the output above for details.  Re-run with --resume to skip the stages which completed" % failed + style.RESET)
+                exit(1)
+    finally:
+        ssh_pool.close()
 
 if __name__ == "__main__":
     main()
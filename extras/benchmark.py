@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+""" Offline deploy.py benchmark
+
+Drives deploy.main() end to end against synthetic clusters with every remote
+backend replaced by a local stand-in:
+
+* bkr and klist by extras/fakes/bkr and extras/fakes/klist
+* DNS by a resolver giving every synthetic host its own address
+* paramiko by an in-process fake with configurable latency and failures.
+  Connections that still fail after --ssh-retries fail the deploy, which is
+  reported next to the timings
+* the ansible ping runner and inventory by in-process fakes
+* ansible-playbook by extras/fakes/ansible-playbook
+
+Each cluster size runs in its own child process so peak memory is measured
+per run.  The wall time, growth of the peak memory and subprocess count of
+every stage, and the peak memory of the run, are read back from the run
+profile deploy.py writes.
+
+  $ python extras/benchmark.py                       # 3, 30 and 300 hosts
+  $ python extras/benchmark.py --sizes 30 --ssh-latency 0.2 --output base.json
+  $ python extras/benchmark.py --compare base.json   # regressions vs a baseline
+
+colored and IPy from extras/requirements.txt still need to be installed.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+EXTRAS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(EXTRAS)
+FAKES = os.path.join(EXTRAS, "fakes")
+
+GROUP_VARS_SAMPLES = {
+    "all.sample": "#ceph_stable_rh_storage: false\n#journal_size: 0\n"
+                  "#public_network: 0.0.0.0/0\n"
+                  "#cluster_network: \"{{ public_network }}\"\n#cephx: true\n",
+    "osds.sample": "#cephx: true\n#osd_auto_discovery: false\n"
+                   "#journal_collocation: false\n",
+}
+LSBLK_OUTPUT = ('NAME="sda" SIZE="500107862016" TYPE="disk" ROTA="1" MOUNTPOINT=""\n'
+                'NAME="sdb" SIZE="2000398934016" TYPE="disk" ROTA="1" MOUNTPOINT=""\n')
+# subscription-manager probe of an unregistered host
+SUBSCRIPTION_OUTPUT = "--deploy.py--\n--deploy.py--\n"
+
+
+""" In-process stand-ins for paramiko and ansible """
+def fake_paramiko(latency, failure_rate):
+    paramiko = types.ModuleType("paramiko")
+    rng = random.Random(42)
+    rng_lock = threading.Lock()
+
+    class SSHException(Exception):
+        pass
+
+    class AutoAddPolicy(object):
+        pass
+
+    class Transport(object):
+        def is_active(self):
+            return True
+
+    class Channel(object):
+        def __init__(self, status):
+            self.status = status
+
+        def recv_exit_status(self):
+            return self.status
+
+    class ChannelFile(object):
+        def __init__(self, data, status=0):
+            self.data = data
+            self.channel = Channel(status)
+
+        def read(self):
+            return self.data
+
+    class SSHClient(object):
+        def __init__(self):
+            self.transport = None
+
+        def set_missing_host_key_policy(self, policy):
+            pass
+
+        def connect(self, host, **kwargs):
+            time.sleep(latency)
+            with rng_lock:
+                failed = rng.random() < failure_rate
+            if failed:
+                raise socket.error("fake connection reset by %s" % host)
+            self.transport = Transport()
+
+        def get_transport(self):
+            return self.transport
+
+        def exec_command(self, command, **kwargs):
+            time.sleep(latency)
+            output = ""
+            if command.startswith("lsblk"):
+                output = LSBLK_OUTPUT
+            elif command.startswith("subscription-manager identity"):
+                output = SUBSCRIPTION_OUTPUT
+            return None, ChannelFile(output), ChannelFile("")
+
+        def close(self):
+            self.transport = None
+
+    paramiko.SSHException = SSHException
+    paramiko.AutoAddPolicy = AutoAddPolicy
+    paramiko.SSHClient = SSHClient
+    return paramiko
+
+
+def fake_getaddrinfo():
+    getaddrinfo = socket.getaddrinfo
+
+    def resolve(host, port, *args, **kwargs):
+        if not host.endswith(".bench.example.com"):
+            return getaddrinfo(host, port, *args, **kwargs)
+        n = int(host[len("node"):host.index(".")])
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                 ("10.0.%d.%d" % divmod(n + 1, 256), port))]
+    return resolve
+
+
+def fake_ansible(latency):
+    ansible = types.ModuleType("ansible")
+    runner = types.ModuleType("ansible.runner")
+    playbook = types.ModuleType("ansible.playbook")
+    inventory = types.ModuleType("ansible.inventory")
+
+    class Host(object):
+        def __init__(self, name):
+            self.name = name
+            self.vars = {}
+
+        def set_variable(self, key, value):
+            self.vars[key] = value
+
+    class Group(object):
+        def __init__(self, name=None):
+            self.name = name
+            self.hosts = []
+
+        def add_host(self, host):
+            self.hosts.append(host)
+
+        def add_child_group(self, group):
+            pass
+
+        def get_hosts(self):
+            return self.hosts
+
+    class Inventory(object):
+        def __init__(self, host_list=None):
+            self.groups = [Group("all")]
+            for host in host_list or []:
+                self.groups[0].add_host(Host(host))
+
+        def get_group(self, name):
+            for group in self.groups:
+                if group.name == name:
+                    return group
+
+        def add_group(self, group):
+            self.groups.append(group)
+
+    class DefaultRunnerCallbacks(object):
+        def on_ok(self, host, res):
+            pass
+
+    class Runner(object):
+        def __init__(self, **kwargs):
+            self.pattern = kwargs.get("pattern", "all")
+            self.callbacks = kwargs.get("callbacks") or DefaultRunnerCallbacks()
+
+        def run(self):
+            time.sleep(latency)
+            hosts = self.pattern.split(":")
+            for host in hosts:
+                self.callbacks.on_ok(host, {"ping": "pong"})
+            return {"contacted": dict((host, {"ping": "pong"}) for host in hosts),
+                    "dark": {}}
+
+    runner.Runner = Runner
+    inventory.Inventory = Inventory
+    group = types.ModuleType("ansible.inventory.group")
+    group.Group = Group
+    inventory.group = group
+    ansible.runner = runner
+    ansible.playbook = playbook
+    ansible.inventory = inventory
+    ansible.callbacks = types.ModuleType("ansible.callbacks")
+    ansible.callbacks.DefaultRunnerCallbacks = DefaultRunnerCallbacks
+    ansible.utils = types.ModuleType("ansible.utils")
+    return {"ansible": ansible, "ansible.runner": runner,
+            "ansible.playbook": playbook, "ansible.inventory": inventory,
+            "ansible.inventory.group": group,
+            "ansible.callbacks": ansible.callbacks,
+            "ansible.utils": ansible.utils}
+
+
+""" Child: one deploy.main() run """
+def prepare_workdir(workdir, hosts):
+    home = os.path.join(workdir, "home")
+    os.makedirs(os.path.join(home, ".ssh"))
+    with open(os.path.join(home, ".ssh", "id_rsa.pub"), "w") as f:
+        f.write("ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC benchmark@localhost\n")
+    with open(os.path.join(home, ".ssh", "known_hosts"), "w") as f:
+        for host in hosts:
+            f.write("%s ssh-rsa AAAAB3NzaC1yc2E\n" % host)
+        for n in range(10000):
+            f.write("unrelated%d.example.com ssh-rsa AAAAB3NzaC1yc2E\n" % n)
+    os.makedirs(os.path.join(workdir, "extras"))
+    with open(os.path.join(workdir, "extras", "deploy.cfg"), "w") as f:
+        f.write("subscriptionUsername=benchmark\nsubscriptionPassword=benchmark\n"
+                "beakerPassword=benchmark\n")
+    playbook = os.path.join(workdir, "ceph-ansible")
+    os.makedirs(os.path.join(playbook, "group_vars"))
+    for name, content in GROUP_VARS_SAMPLES.items():
+        with open(os.path.join(playbook, "group_vars", name), "w") as f:
+            f.write(content)
+    open(os.path.join(playbook, "site.yml"), "w").close()
+    return home, playbook
+
+
+def run_child(options):
+    hosts = ["node%03d.bench.example.com" % n for n in range(options.child)]
+    mons = hosts[:min(3, len(hosts))]
+    osds = hosts[len(mons):] or hosts
+    workdir = tempfile.mkdtemp(prefix="deploy-benchmark-")
+    try:
+        home, playbook = prepare_workdir(workdir, hosts)
+        os.environ.update({
+            "HOME": home,
+            "PATH": FAKES + os.pathsep + os.environ.get("PATH", ""),
+            "DEPLOY_BKR": os.path.join(FAKES, "bkr"),
+            "FAKE_BKR_DIR": os.path.join(workdir, "bkr"),
+            "FAKE_BKR_SUBMIT_DELAY": str(options.bkr_latency),
+            "FAKE_BKR_RESULTS_DELAY": str(options.bkr_latency),
+            "FAKE_BKR_READY_AFTER": str(options.ready_after),
+            "FAKE_ANSIBLE_TASK_DELAY": str(options.ansible_task_delay),
+        })
+        sys.modules["paramiko"] = fake_paramiko(options.ssh_latency,
+                                                options.failure_rate)
+        sys.modules.update(fake_ansible(options.ssh_latency))
+        socket.getaddrinfo = fake_getaddrinfo()
+        sys.path.insert(0, REPO)
+        import deploy
+
+        os.chdir(workdir)
+        sys.argv = ["deploy.py", "-m", ",".join(mons), "-o", ",".join(osds),
+                    "-d", playbook, "-p", "10.0.0.0/8", "-c", "10.0.0.0/8",
+                    "--beaker-poll-interval", "1",
+                    "--ssh-retries", "5"] + options.deploy_args
+        start = time.time()
+        status = 0
+        # deploy.py prints a lot, keep the benchmark output readable
+        devnull = open(os.devnull, "w")
+        sys.stdout = devnull
+        try:
+            deploy.main()
+        except SystemExit as e:
+            status = e.code or 0
+        wall = time.time() - start
+        profile_path = sorted(glob.glob("extras/profiles/*.json"))[-1]
+        with open(profile_path) as f:
+            profile = json.load(f)
+        result = {"hosts": len(hosts), "status": status, "wall": wall,
+                  "max_rss_kb": profile["max_rss_kb"],
+                  "stages": dict((stage, {"wall": record["wall"],
+                                          "peak_rss_growth_kb": record["peak_rss_growth_kb"],
+                                          "subprocesses": record["subprocesses"],
+                                          "ssh_connections": record["ssh_connections"],
+                                          "retries": record["retries"]})
+                                 for stage, record in profile["stages"].items())}
+        with open(options.result_file, "w") as f:
+            json.dump(result, f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # A failed deploy can leave stage threads behind, don't wait on them
+    os._exit(0)
+
+
+""" Parent: run each size and report """
+def run_size(size, options):
+    fd, result_file = tempfile.mkstemp(prefix="deploy-benchmark-", suffix=".json")
+    os.close(fd)
+    argv = [sys.executable, os.path.abspath(__file__), "--child", str(size),
+            "--result-file", result_file,
+            "--ssh-latency", str(options.ssh_latency),
+            "--bkr-latency", str(options.bkr_latency),
+            "--ready-after", str(options.ready_after),
+            "--ansible-task-delay", str(options.ansible_task_delay),
+            "--failure-rate", str(options.failure_rate)]
+    if options.deploy_args:
+        argv += ["--"] + options.deploy_args
+    try:
+        if subprocess.call(argv) != 0:
+            raise SystemExit("benchmark run for %d hosts failed" % size)
+        with open(result_file) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_file)
+
+
+def print_result(result):
+    print("\n%d hosts: %.1fs total, peak rss %d KB%s" % (
+        result["hosts"], result["wall"], result["max_rss_kb"],
+        "" if result["status"] == 0 else " (deploy exited %s)" % result["status"]))
+    print("%-20s%10s%14s%12s%12s%10s" % ("stage", "wall", "peak growth", "processes",
+                                         "ssh conns", "retries"))
+    for stage, record in sorted(result["stages"].items(),
+                                key=lambda item: -item[1]["wall"]):
+        print("%-20s%9.2fs%11d KB%12d%12d%10d" % (
+            stage, record["wall"], record["peak_rss_growth_kb"], record["subprocesses"],
+            record["ssh_connections"], record["retries"]))
+
+
+# Flag every stage that got more than tolerance slower than the baseline
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = dict((str(r["hosts"]), r) for r in json.load(f))
+    regressions = []
+    for result in results:
+        base = baseline.get(str(result["hosts"]))
+        if base is None:
+            continue
+        for stage, record in result["stages"].items():
+            before = base["stages"].get(stage, {}).get("wall")
+            if before and record["wall"] > before * (1 + tolerance) + 0.5:
+                regressions.append("%d hosts %s: %.2fs -> %.2fs" % (
+                    result["hosts"], stage, before, record["wall"]))
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark deploy.py against \
+                                     simulated beaker, ssh and ansible backends.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 30, 300],
+                        help="Cluster sizes to deploy. (Default: 3 30 300)")
+    parser.add_argument("--ssh-latency", type=float, default=0.05,
+                        help="Seconds per fake ssh connect/command and ping.")
+    parser.add_argument("--bkr-latency", type=float, default=0.05,
+                        help="Seconds per fake bkr call.")
+    parser.add_argument("--ready-after", type=float, default=3,
+                        help="Seconds until a fake beaker job is Completed.")
+    parser.add_argument("--ansible-task-delay", type=float, default=0.05,
+                        help="Seconds per fake ansible-playbook task.")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Probability that a fake ssh connection fails and \
+                        has to be retried.")
+    parser.add_argument("--output", help="Write the results as json, for use \
+                        as a --compare baseline.")
+    parser.add_argument("--compare", help="Exit non-zero if any stage is slower \
+                        than in this baseline by more than --tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    parser.add_argument("deploy_args", nargs="*",
+                        help="Extra deploy.py arguments, after --.")
+    options = parser.parse_args()
+
+    if options.child is not None:
+        run_child(options)
+        return 0
+
+    results = []
+    for size in options.sizes:
+        result = run_size(size, options)
+        print_result(result)
+        results.append(result)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if options.compare:
+        return compare(results, options.compare, options.tolerance)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
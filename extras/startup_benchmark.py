@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+""" deploy.py startup benchmark
+
+Times the deploy.py code paths which exit before any deploy stage runs
+(--help and argument validation errors), the ones wrapper scripts hit on
+every dry run.  Each run happens in a fresh interpreter so the import cost
+is measured too, and the run fails if any of the heavy backends deploy.py
+only needs for its stages got imported.
+
+  $ python extras/startup_benchmark.py
+  $ python extras/startup_benchmark.py --repeat 20 --output startup.json
+  $ python extras/startup_benchmark.py --compare startup.json
+
+colored from extras/requirements.txt still needs to be installed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+EXTRAS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(EXTRAS)
+
+# Modules which must not be imported before a deploy stage needs them
+HEAVY_MODULES = ("paramiko", "ansible", "IPy")
+
+# name -> deploy.py arguments, all of which exit before any stage runs
+SCENARIOS = [
+    ("help", ["--help"]),
+    ("missing argument", ["-m", "ceph1.example.com"]),
+    ("invalid host", ["-m", "ceph1.example.com", "-o", "not_a_host!",
+                      "-d", "/tmp", "-p", "10.0.0.0/8"]),
+    ("invalid choice", ["--ssh-backend", "telnet"]),
+]
+
+
+""" Child: one deploy.main() call """
+def run_child(options):
+    start = time.time()
+    sys.path.insert(0, REPO)
+    sys.argv = ["deploy.py"] + options.deploy_args
+    devnull = open(os.devnull, "w")
+    sys.stdout = sys.stderr = devnull
+    try:
+        import deploy
+        deploy.main()
+    except SystemExit:
+        pass
+    elapsed = time.time() - start
+    loaded = sorted(name for name in sys.modules
+                    if name.split(".")[0] in HEAVY_MODULES and sys.modules[name])
+    with open(options.result_file, "w") as f:
+        json.dump({"main": elapsed, "heavy_modules": loaded}, f)
+
+
+""" Parent: run every scenario and report """
+def run_scenario(name, deploy_args, repeat):
+    fd, result_file = tempfile.mkstemp(prefix="deploy-startup-", suffix=".json")
+    os.close(fd)
+    argv = [sys.executable, os.path.abspath(__file__), "--child",
+            "--result-file", result_file, "--"] + deploy_args
+    walls = []
+    mains = []
+    heavy = set()
+    try:
+        for attempt in range(repeat):
+            start = time.time()
+            if subprocess.call(argv, cwd=REPO) != 0:
+                raise SystemExit("startup run for %r failed" % name)
+            walls.append(time.time() - start)
+            with open(result_file) as f:
+                result = json.load(f)
+            mains.append(result["main"])
+            heavy.update(result["heavy_modules"])
+    finally:
+        os.unlink(result_file)
+    return {"scenario": name, "wall": median(walls), "main": median(mains),
+            "heavy_modules": sorted(heavy)}
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def print_results(results):
+    print("%-20s%12s%12s  %s" % ("scenario", "process", "import+main",
+                                 "heavy modules imported"))
+    for result in results:
+        print("%-20s%11.3fs%11.3fs  %s" % (
+            result["scenario"], result["wall"], result["main"],
+            ", ".join(result["heavy_modules"]) or "-"))
+
+
+# Flag every scenario that got more than tolerance slower than the baseline
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = dict((r["scenario"], r) for r in json.load(f))
+    regressions = []
+    for result in results:
+        base = baseline.get(result["scenario"])
+        if base is None:
+            continue
+        if result["wall"] > base["wall"] * (1 + tolerance) + 0.05:
+            regressions.append("%s: %.3fs -> %.3fs" % (
+                result["scenario"], base["wall"], result["wall"]))
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the deploy.py code \
+                                     paths which exit before any stage runs.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per scenario, the median is reported. \
+                        (Default: 5)")
+    parser.add_argument("--output", help="Write the results as json, for use \
+                        as a --compare baseline.")
+    parser.add_argument("--compare", help="Exit non-zero if any scenario is \
+                        slower than in this baseline by more than --tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    parser.add_argument("deploy_args", nargs="*", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        run_child(options)
+        return 0
+
+    results = [run_scenario(name, deploy_args, options.repeat)
+               for name, deploy_args in SCENARIOS]
+    print_results(results)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    failed = False
+    for result in results:
+        if result["heavy_modules"]:
+            print("REGRESSION %s imports %s" % (
+                result["scenario"], ", ".join(result["heavy_modules"])))
+            failed = True
+    if options.compare and compare(results, options.compare, options.tolerance):
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())